@@ -1,13 +1,27 @@
 # https://github.com/CBIIT/bento-meta/blob/master/python/src/bento_meta/model.py
-import pandas as pd
-import numpy as np
 import argparse
-from crdclib import crdclib
-from bento_meta.model import Model, Node, Property, Term, Edge
-from bento_mdf import MDFWriter
-import yaml
-import json
-
+import os
+import re
+import time
+import workbook
+import incremental
+import mdfoutput
+import instrument
+import modeldiff
+import runplan
+import tablecache
+import termpool
+from lazy import lazyImport
+
+# Imported on first use, see lazy.py
+pd = lazyImport('pandas')
+crdclib = lazyImport('crdclib.crdclib')
+bentomodel = lazyImport('bento_meta.model')
+bento_mdf = lazyImport('bento_mdf')
+
+# Characters stripped from every PV, and a quote-aware comma splitter.  A quoted field only counts as quoted if the closing quote ends the field, so apostrophes (Crohn's) don't start a quote.
+PV_STRIP = str.maketrans('', '', "'[]\"")
+PV_FIELD = re.compile(r"""[\s\[]*(?:"[^"]*"|'[^']*'(?=[\s\]]*(?:,|$)))[\s\]]*|[^,]+""")
 
 
 def cleanColumnNames(oldnamelist):
@@ -32,50 +46,151 @@ def cleanEnums(startlist):
             cleaned.append(entry)
     return cleaned
 
+
+def normalizeEnum(pvstring):
+    # One Permissible Value cell to a cleaned, deduplicated enum list.  None if the cell has no PVs
+    if pvstring == '-':
+        return None
+    # Split first, then strip the offending characters from the whole cell in one translate call
+    cleaned = '\0'.join(PV_FIELD.findall(str(pvstring))).translate(PV_STRIP).split('\0')
+    enumlist = list(dict.fromkeys(entry.strip() for entry in cleaned))
+    enumlist = [entry for entry in enumlist if entry != '']
+    if len(enumlist) > 0:
+        return enumlist
+    return None
+
+
+def normalizeEnums(pv_series):
+    # Batch PV cleaning.  Takes a Series of raw Permissible Value cells and returns a Series of cleaned, deduplicated enum lists (NaN where there are no PVs)
+    # Each distinct cell is only normalized once, the same PV text is repeated a lot in the sheet
+    normalized = {}
+    for pvstring in pv_series.dropna().unique():
+        enumlist = normalizeEnum(pvstring)
+        if enumlist is not None:
+            normalized[pvstring] = enumlist
+    return pv_series.map(normalized)
+
+
 def addNodes(datamodel, nodelist):
     # Add a list of nodes to the model
     for node in nodelist:
-        nodeobj = Node({'handle': node})
+        nodeobj = bentomodel.Node({'handle': node})
         datamodel.add_node(nodeobj)
     return datamodel
 
-def addEnums(propname, df):
-    # Returns a list of permissible values
-    enumlist = None
-    enum_df = df.query('Property == @propname')
-    for index, row in enum_df.iterrows():
-        if row['Permissible Value'] not in ['-', np.nan]:
-            enumlist = row['Permissible Value'].split(',')
-    enumlist = cleanEnums(enumlist)
-    return enumlist
+def addProp(datamodel, df, nodelist):
+    # Adds properties to the model.  Will add PVs if present
+    return addPropEntries(datamodel, propEntries(df, nodelist))
+
+
+def addPropEntries(datamodel, nodes):
+    # Adds the {node: {property: [data type, enum list]}} entries from propEntries or streamProps.  PVs shared by properties share one Term
+    pool = termpool.TermPool()
+    for nodename, props in nodes.items():
+        for propname, (datatype, enumset) in props.items():
+            datamodel = addPropEntry(datamodel, nodename, propname, datatype, enumset, pool)
+    instrument.count('term_objects', len(pool))
+    instrument.count('term_uses', pool.uses)
+    return datamodel
+
 
+def propEntries(df, nodelist):
+    # DataFrame version of streamProps, {node: {property: [data type of the first row, enum list of the last row with PVs]}} for the nodes in nodelist
+    # Single pass over the sheet: one row per (Node, Property), keeping sheet order within each node
+    working_df = df[df['Node'].isin(nodelist)].copy()
+    working_df['Node'] = pd.Categorical(working_df['Node'], categories=nodelist)
+    working_df = working_df.sort_values('Node', kind='stable')
 
+    # The last populated PV cell for a property wins
+    working_df['Enums'] = normalizeEnums(working_df['Permissible Value'])
+    enum_df = working_df[working_df['Enums'].notna()].drop_duplicates(subset=['Node', 'Property'], keep='last')
+    enummap = dict(zip(zip(enum_df['Node'].astype(str), enum_df['Property']), enum_df['Enums']))
 
-def addProp(datamodel, df, nodelist):
-    # Adds properties to the model.  Will add PVs if present
-    for nodename in nodelist:
-        working_df = df.query('Node == @nodename')
-        for index, row in working_df.iterrows():
-            propname = row['Property']
-            datatype = row['Data Type']
-            nodes = datamodel.nodes
-            existing = list(nodes[nodename].props.keys())
-            #Only add a new property if it's not there
-            if propname not in existing:
-                enumset = addEnums(propname, working_df)
-                nodeobj = datamodel.nodes[nodename]
-                if enumset is not None:
-                    propdict = {'handle': propname, "_parent_handle": nodename, 'is_required': 'No', 'value_domain': 'value_set'}
-                else:
-                    propdict = {'handle': propname, "_parent_handle": nodename, 'is_required': 'No', 'value_domain': datatype}
-                propobj = Property(propdict)
-                
-                datamodel.add_prop(nodeobj, propobj)
-                if enumset is not None:
-                    workingprop = datamodel.props[(nodename, propname)]
-                    datamodel.add_terms(workingprop, *enumset)
+    prop_df = working_df.drop_duplicates(subset=['Node', 'Property'], keep='first')
+    nodes = {nodename: {} for nodename in nodelist}
+    for nodename, propname, datatype in zip(prop_df['Node'].astype(str), prop_df['Property'], prop_df['Data Type']):
+        nodes[nodename][propname] = [datatype, enummap.get((nodename, propname))]
+    return nodes
+
+
+def addPropEntry(datamodel, nodename, propname, datatype, enumset=None, pool=None):
+    # Adds one property, as a value_set if it has PVs.  With a termpool.TermPool the PVs use its Terms instead of new ones
+    nodeobj = datamodel.nodes[nodename]
+    if enumset is not None:
+        propdict = {'handle': propname, "_parent_handle": nodename, 'is_required': 'No', 'value_domain': 'value_set'}
+    else:
+        propdict = {'handle': propname, "_parent_handle": nodename, 'is_required': 'No', 'value_domain': datatype}
+    propobj = bentomodel.Property(propdict)
+
+    datamodel.add_prop(nodeobj, propobj)
+    if enumset is not None:
+        workingprop = datamodel.props[(nodename, propname)]
+        if pool is not None:
+            pool.addTerms(datamodel, workingprop, enumset)
+        else:
+            datamodel.add_terms(workingprop, *enumset)
     return datamodel
 
+
+def streamProps(rows):
+    # Streaming version of addProp.  Takes an iterator of row dictionaries and keeps only what the model needs from each row:
+    # {node: {property: [data type of the first row, enum list of the last row with PVs]}}, nodes and properties in sheet order
+    nodes = {}
+    enumcache = {}
+    for row in rows:
+        instrument.count('rows')
+        nodename = row.get('Node')
+        propname = row.get('Property')
+        if nodename is None or nodename == '-' or propname is None:
+            continue
+        props = nodes.setdefault(str(nodename), {})
+        if propname not in props:
+            props[propname] = [row.get('Data Type'), None]
+        pvstring = row.get('Permissible Value')
+        if pvstring is not None:
+            if pvstring not in enumcache:
+                enumcache[pvstring] = normalizeEnum(pvstring)
+            if enumcache[pvstring] is not None:
+                props[propname][1] = enumcache[pvstring]
+    return nodes
+
+
+def entriesModel(nodes, handle, version):
+    # A model holding just the propEntries/streamProps entries
+    return addPropEntries(addNodes(bentomodel.Model(handle=handle, version=version), list(nodes.keys())), nodes)
+
+
+def streamModel(rows, handle, version):
+    # Builds the model from a stream of rows without ever holding the sheet in memory
+    return entriesModel(streamProps(rows), handle, version)
+
+
+def propTables(nodes):
+    # The propEntries/streamProps entries as tablecache tables
+    tables = {'nodes': {'node': list(nodes)}, 'props': {'node': [], 'prop': [], 'datatype': []}, 'enums': {'node': [], 'prop': [], 'value': []}}
+    for nodename, props in nodes.items():
+        for propname, (datatype, enumset) in props.items():
+            tables['props']['node'].append(nodename)
+            tables['props']['prop'].append(propname)
+            tables['props']['datatype'].append(None if pd.isna(datatype) else datatype)
+            for enum in enumset or []:
+                tables['enums']['node'].append(nodename)
+                tables['enums']['prop'].append(propname)
+                tables['enums']['value'].append(enum)
+    return tables
+
+
+def tablesProps(tables):
+    # Back from propTables to the {node: {property: [data type, enum list]}} entries
+    nodes = {row['node']: {} for row in tablecache.rows(tables['nodes'])}
+    for row in tablecache.rows(tables['props']):
+        nodes[row['node']][row['prop']] = [row['datatype'], None]
+    for row in tablecache.rows(tables['enums']):
+        if nodes[row['node']][row['prop']][1] is None:
+            nodes[row['node']][row['prop']][1] = []
+        nodes[row['node']][row['prop']][1].append(row['value'])
+    return nodes
+
 '''
 def addEnum(datamodel, df):
     # Not being used
@@ -86,7 +201,7 @@ def addEnum(datamodel, df):
         propname = prop[1]
         temp_df = df.query('Property == @propname')
         for index, row in temp_df.iterrows():
-            if row['Permissible Value'] not in ['-', np.nan]:
+            if row['Permissible Value'] != '-' and pd.notna(row['Permissible Value']):
                 messylist = row['Permissible Value'].split(',')
                 addprop = datamodel.props[(nodename,propname)]
                 datamodel.add_terms(addprop, *messylist)
@@ -98,6 +213,7 @@ def addTerm(datamodel, df):
     # Adds terms to a Property.  Currently not used
     # TODO: This needs a revisit.  The ENUM stuff needs to be removed, those are set in Props, not Terms.
     proplist = df['Property'].unique()
+    enumlists = normalizeEnums(df['Permissible Value'])
     # This is a stupid safety valve because some rows are multi-mapped and therefore terms are duplicated.
     checkit = []
     for propname in proplist:
@@ -109,78 +225,213 @@ def addTerm(datamodel, df):
             cdeid = 'NA'
             description = 'None'
             cdeurl = 'None'
-            if row['Permissible Value'] not in ['-', np.nan]:
-                # These are an unholy mess, only thing to do is split on a comma
-                messylist = row['Permissible Value'].split(',')
-                termvalues = {'handle': propname, 'Enum': messylist}
-                termobj = Term(termvalues)
+            enumlist = enumlists[index]
+            if isinstance(enumlist, list):
+                termvalues = {'handle': propname, 'Enum': enumlist}
+                termobj = bentomodel.Term(termvalues)
                 propobj = datamodel.props[(nodename, propname)]
                 datamodel.add_terms(propobj, termobj)
     return datamodel
 
 
 
-def writeFiles(mdf, configs):
-    # This writes out the separate mode, property, etc., if reuested in the config.
-    jsonobj = json.dumps(MDFWriter(mdf).mdf)
-    mdfdict = json.loads(jsonobj)
-
-    for entry in configs['mdffiles']:
-        for mdfsection, filename in entry.items():
-            printnode = {}
-            printnode[mdfsection] = mdfdict.pop(mdfsection, None)
-            crdclib.writeYAML(configs['workingpath']+filename, printnode)
-    #After printing out the requested sections, print out what's left
-    crdclib.writeYAML(configs['workingpath']+configs['mdffile'], mdfdict)
+def writeFiles(mdfdict, configs):
+    # This writes out the separate mode, property, etc., if reuested in the config.  Whatever is left goes in mdffile.
+    # Files that already have the right content are left alone.  Returns {filename: fingerprint}
+    outputs = [(configs['workingpath']+filename, section) for filename, section in mdfoutput.splitSections(mdfdict, configs['mdffiles'], configs['mdffile'])]
+    return mdfoutput.writeSections(outputs, configs.get('output_workers'), configs.get('streamoutput', False))
 
 
+def shardPath(configs):
+    return configs.get('shardpath', configs['workingpath']+'shards/')
 
 
+def mdfFileList(configs, handle='CIDC'):
+    # The MDF files a run writes with this config, in load order
+    if configs.get('sharding'):
+        manifestfile = f"{shardPath(configs)}{handle}_shards.yml"
+        return mdfoutput.shardFiles(manifestfile) if os.path.exists(manifestfile) else []
+    if configs['separate_files']:
+        restfile = configs['mdffile']
+        filelist = []
+        for entry in configs['mdffiles']:
+            for mdfsection, filename in entry.items():
+                if mdfsection == 'Model':
+                    restfile = filename
+                else:
+                    filelist.append(configs['workingpath']+filename)
+        return [configs['workingpath']+restfile] + filelist
+    return [configs['workingpath']+configs['mdffile']]
 
-def main(args):
-    # Read the config file
-    configs = crdclib.readYAML(args.configfile)
-    # Create a dataframe from the Excel sheet
-    cidc_df = pd.read_excel(configs['workingpath']+configs['excelfile'], sheet_name=configs['worksheet'], usecols="G:K", header=8)
 
-    # The header names are problematic, rename
-    newcols = cleanColumnNames(cidc_df.columns.to_list())
-    cidc_df.rename(columns=newcols, inplace=True)
+def diffModel(mdfdict, configs, args, handle='CIDC'):
+    # Changelog and patch MDF against the files the last run left.  Has to run before they're overwritten
+    if args.changelog is None and args.patch is None:
+        return None
+    with instrument.stage('diff'):
+        return modeldiff.writeDiff(mdfFileList(configs, handle), mdfdict, args.changelog, args.patch, f"{handle} {mdfdict.get('Version')}", args.verbose)
 
-    # Get the list of nodes
-    cidc_nodes = cidc_df['Node'].unique().tolist()
-    # Clean out a couple of bad values
-    cidc_nodes.remove('-')
-    cidc_nodes.remove(np.nan)
 
 
-    # Create an empty model
-    cidc_mdf = Model(handle='CIDC', version='0.01')
 
-    # Add nodes
-    cidc_mdf = addNodes(cidc_mdf, cidc_nodes)
-    # Add properties and Enums
-    cidc_mdf = addProp(cidc_mdf, cidc_df, cidc_nodes)
-    # Add terms
-    #cidc_df = addTerm(cidc_mdf, cidc_df)
-    # Add Enums:
-    # cidc_mdf = addEnum(cidc_mdf, cidc_df)
 
-    #Attempt to write da model
-    if configs['separate_files']:
-        writeFiles(cidc_mdf, configs)
+def planModel(configs, args, handle='CIDC'):
+    # --plan: reads the rows the same way --stream does and reports what the model and output would be, without building either
+    sourcefile = configs['workingpath']+configs['excelfile']
+    if args.stream:
+        sourcefile = configs['workingpath']+configs.get('csvfile', configs['excelfile'])
+    nodes = streamProps(workbook.iterRows(sourcefile, configs['worksheet'], 8, "G:K", lambda name: name.split('.')[0]))
+    enumsets = [enumset for props in nodes.values() for datatype, enumset in props.values() if enumset is not None]
+    counts = {'nodes': len(nodes), 'properties': sum(len(props) for props in nodes.values()), 'enum properties': len(enumsets),
+              'distinct enum values': len(set().union(*enumsets))}
+    if configs.get('sharding'):
+        files = runplan.shardFileList(shardPath(configs), handle, {nodename: list(props) for nodename, props in nodes.items()}, configs['sharding'])
     else:
-        filename = configs['workingpath']+configs['mdffile']
-        with open(filename, "w") as f:
-            f.write(yaml.dump(MDFWriter(cidc_mdf).mdf, indent=4))
-        f.close()
+        files = mdfFileList(configs, handle)
+    for extra in [args.changelog, args.patch]:
+        if extra is not None and extra != '-':
+            files.append(extra)
+    runplan.printPlan(f"{handle} model from {configs['worksheet']}", counts, files)
+    return counts
+
+
+def main(args, configs=None):
+    # Read the config file, unless it was passed in already loaded (batch2mdf.py)
+    if configs is None:
+        with instrument.stage('config'):
+            configs = crdclib.readYAML(args.configfile)
+    if args.plan:
+        planModel(configs, args)
+        return
+    if args.from_cache and 'tablecache' not in configs:
+        print("--from-cache needs tablecache set in the config")
+        return
+    # --stream reads the CSV export of the worksheet if there is one
+    sourcefile = configs['workingpath']+configs['excelfile']
+    if args.stream and 'csvfile' in configs:
+        sourcefile = configs['workingpath']+configs['csvfile']
+    # The whole model comes from one sheet, so an incremental run either skips everything or rebuilds everything.  Cached runs don't look at the sheet
+    incrementalrun = args.incremental and not args.from_cache
+    if incrementalrun:
+        with instrument.stage('fingerprint'):
+            manifestfile = incremental.manifestFile(configs, '.cidc2mdf_manifest.json')
+            manifest = incremental.readManifest(manifestfile)
+            # Fingerprint whichever file the rows come from
+            if args.stream and 'csvfile' in configs:
+                fingerprints = {configs['csvfile']: incremental.fileFingerprint(sourcefile)}
+            else:
+                fingerprints = workbook.sheetFingerprints(sourcefile)
+                fingerprints = {configs['worksheet']: fingerprints[configs['worksheet']]}
+            confighash = incremental.configFingerprint(configs)
+        if len(incremental.changedSheets(manifest, fingerprints, confighash)) == 0 and incremental.outputsCurrent(manifest):
+            if args.verbose >= 1:
+                print("Model is up to date, nothing to rebuild")
+            return
+    if args.from_cache:
+        # The nodes and properties come from the tables an earlier run saved, the workbook isn't opened
+        with instrument.stage('tablecache'):
+            tables, meta = tablecache.readTables(configs['tablecache'])
+        if args.verbose >= 1:
+            print(f"Building from the tables cached from {meta.get('source')} at {time.ctime(meta['written'])}")
+        with instrument.stage('build_model'):
+            nodes = tablesProps(tables)
+            cidc_mdf = entriesModel(nodes, 'CIDC', '0.01')
+    elif args.stream:
+        # Rows are read one at a time from the sheet, or from a CSV export of it, and never held as a DataFrame
+        with instrument.stage('stream_model'):
+            # Header names get the same renaming as cleanColumnNames
+            rows = workbook.iterRows(sourcefile, configs['worksheet'], 8, "G:K", lambda name: name.split('.')[0])
+            nodes = streamProps(rows)
+            cidc_mdf = entriesModel(nodes, 'CIDC', '0.01')
+    else:
+        # Create a dataframe from the Excel sheet
+        with instrument.stage('excel'):
+            with workbook.openWorkbook(configs['workingpath']+configs['excelfile'], configs.get('excelengine')) as xlfile:
+                cidc_df = workbook.readSheet(xlfile, configs['worksheet'], "G:K", header=8)
+        instrument.count('rows', len(cidc_df))
+
+        # The header names are problematic, rename
+        newcols = cleanColumnNames(cidc_df.columns.to_list())
+        cidc_df.rename(columns=newcols, inplace=True)
+
+        # Get the list of nodes
+        cidc_nodes = cidc_df['Node'].unique().tolist()
+        # Clean out a couple of bad values
+        cidc_nodes.remove('-')
+        cidc_nodes = [node for node in cidc_nodes if pd.notna(node)]
+
+
+        with instrument.stage('build_model'):
+            # Create an empty model
+            cidc_mdf = bentomodel.Model(handle='CIDC', version='0.01')
+
+            # Add nodes
+            cidc_mdf = addNodes(cidc_mdf, cidc_nodes)
+            # Add properties and Enums
+            nodes = propEntries(cidc_df, cidc_nodes)
+            cidc_mdf = addPropEntries(cidc_mdf, nodes)
+            # Add terms
+            #cidc_df = addTerm(cidc_mdf, cidc_df)
+            # Add Enums:
+            # cidc_mdf = addEnum(cidc_mdf, cidc_df)
+    if 'tablecache' in configs and not args.from_cache:
+        with instrument.stage('tablecache'):
+            tablecache.writeTables(propTables(nodes), configs['tablecache'], configs.get('tablecacheformat', 'feather'),
+                                   handle=cidc_mdf.handle, version=cidc_mdf.version, source=os.path.basename(sourcefile))
+    instrument.count('nodes', len(cidc_mdf.nodes))
+    instrument.count('props', len(cidc_mdf.props))
+    instrument.count('terms', len(cidc_mdf.terms))
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    #Attempt to write da model
+    with instrument.stage('serialize'):
+        mdfdict = bento_mdf.MDFWriter(cidc_mdf).mdf
+    diffModel(mdfdict, configs, args, cidc_mdf.handle)
+    if configs.get('sharedenums'):
+        instrument.count('enum_lists', mdfoutput.shareEnums(mdfdict))
+    with instrument.stage('write'):
+        if configs.get('sharding'):
+            shardsize = None if configs['sharding'] == 'node' else int(configs['sharding'])
+            outputs = mdfoutput.writeShardedMDF(mdfdict, mdfoutput.nodeTerms(cidc_mdf), shardPath(configs), cidc_mdf.handle, shardsize, configs.get('output_workers'))
+        elif configs['separate_files']:
+            outputs = writeFiles(mdfdict, configs)
+        else:
+            filename = configs['workingpath']+configs['mdffile']
+            written, fingerprint = mdfoutput.writeYAMLFile(filename, mdfdict, configs.get('streamoutput', False), sort=True, indent=4)
+            outputs = {filename: fingerprint}
+    instrument.count('output_files', len(outputs))
+
+    if incrementalrun:
+        manifest['config'] = confighash
+        manifest['sheets'] = fingerprints
+        manifest['outputs'] = outputs
+        incremental.writeManifest(manifestfile, manifest)
+
+def addArguments(parser):
+    # The command line options, shared with mdfconvert.py
     parser.add_argument("-c", "--configfile", required=True,  help="Configuration file containing all the input info")
     parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
+    parser.add_argument('--incremental', action='store_true', help="Skip the rebuild if the worksheet and config haven't changed since the last incremental run")
+    parser.add_argument('--stream', action='store_true', help="Read the worksheet (or csvfile) a row at a time instead of loading it into a DataFrame")
+    parser.add_argument('--plan', action='store_true', help="Only report what a run would do: node, property and enum counts and the files written.  Nothing is built or written")
+    parser.add_argument('--from-cache', action='store_true', help="Build from the tables saved in tablecache by an earlier run instead of the worksheet")
+    parser.add_argument('--changelog', help="Compare the new model to the MDF files from the last run and write a changelog to this file ('-' for stdout)")
+    parser.add_argument('--patch', help="Write an MDF file holding only the entries added or changed since the last run")
+    parser.add_argument('--stats', help="Write per-stage timings, counts and peak memory to this JSON file ('-' for stdout)")
+    parser.add_argument('--profile', help="Write a profile of the run to this file.  .html uses pyinstrument if installed, otherwise a cProfile dump")
+    return parser
+
+
+def run(args):
+    # main() with the --stats and --profile handling
+    if args.stats is not None:
+        instrument.enable(script='CIDC2MDF', configfile=args.configfile)
+    if args.profile is not None:
+        instrument.profiled(main, args.profile, args)
+    else:
+        main(args)
+    if args.stats is not None:
+        instrument.writeReport(args.stats)
 
-    args = parser.parse_args()
-
-    main(args)
 
+if __name__ == "__main__":
+    run(addArguments(argparse.ArgumentParser()).parse_args())
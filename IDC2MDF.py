@@ -1,19 +1,33 @@
-from bento_mdf import MDFWriter
-from bento_meta.model import Model
 import argparse
-import pandas as pd
-import requests
+import hashlib
 import json
-
-from bento_meta.model import Node, Property, Term, Tag, Edge
-from bento_mdf.validator import MDFValidator
-from jsonschema import SchemaError, ValidationError
-from yaml.parser import ParserError
-from IPython.display import clear_output
+import os
+import time
 
 #import sys
 #sys.path.append('../CRDCLib/src')
-from crdclib import crdclib
+import cdecache
+import workbook
+import incremental
+import mdfoutput
+import validation
+import instrument
+import loadsheets
+import modeldiff
+import runplan
+import tablecache
+from lazy import lazyImport
+
+# The heavy libraries are only imported once they're used, so --help and config checks start instantly
+pd = lazyImport('pandas')
+crdclib = lazyImport('crdclib.crdclib')
+bento_mdf = lazyImport('bento_mdf')
+modelbuilder = lazyImport('modelbuilder')
+
+# Load sheets are named <prefix><node>.tsv (or .parquet), bundles <prefix minus the _>s.xlsx/.zip
+LOADSHEET_PREFIX = 'NCI_Imaging_Data_Loading_Template_'
+# Column in csvfile holding the node name
+CSV_NODE_COLUMN = 'Node'
 
 
 def cleanHTML(inputstring):
@@ -21,130 +35,152 @@ def cleanHTML(inputstring):
     return outputstring
 
 
-def validateModel(filelist):
-    try:
-        MDFValidator(*filelist, raise_error=True).load_and_validate_schema()
-    except SchemaError as e:
-        clear_output()
-        print(f"Schema error:\n{e}")
+def schemaFile(configs):
+    return configs.get('mdfschema', configs['workingpath']+'mdf-schema.yaml')
 
 
-def getCDEInfo(cdeid, version=None, verbose=0):
-    definition = None
-    cdename = None
-    cdeversion = None
-    if version is None:
-        url = "https://cadsrapi.cancer.gov/rad/NCIAPI/1.0/api/DataElement/"+str(cdeid)
-    else:
-        url = "https://cadsrapi.cancer.gov/rad/NCIAPI/1.0/api/DataElement/"+str(cdeid)+"?version="+str(version)
-    headers = {'accept':'application/json'}
+def validateModel(mdfdict, configs, verbose=0):
+    # Validates the MDF dictionary in memory, before it's split up and written.  Returns the list of errors
+    errors = validation.validateMDF(mdfdict, schemaFile(configs), verbose)
+    validation.printErrors(errors)
+    return errors
 
-    if verbose >= 2:
-        print(f"caDSR URL:\n{url}")
-    try:
-        results = requests.get(url, headers = headers)
-    except requests.exceptions.HTTPError as e:
-        print(e)
-    if results.status_code == 200:
-        results = json.loads(results.content.decode())
-        if results['DataElement'] is not None:
-            if verbose >= 3:
-                print(f"Return caDSR JSON:\n{results['DataElement']}")
-            if 'preferredName' in results['DataElement']:
-                cdename = results['DataElement']['preferredName']
-            else:
-                cdename = results['DataElement']['longName']
-            if 'preferredDefinition' in results['DataElement']:
-                definition = results['DataElement']['preferredDefinition']
-            else:
-                definition = results['DataElement']['definition']
-            cdeversion = results['DataElement']['version']
-    else:
-        cdename = 'caDSR Name Error'
-    if definition is not None:
-        definition = crdclib.cleanString(definition, True)
-    return {'cdename':cdename, 'cdedef':definition, 'cdever':cdeversion}
 
+def revalidateFiles(configs, verbose=0):
+    # Optional: parse the files just written and validate them again
+    errors = validation.validateFiles(mdfFileList(configs), schemaFile(configs), verbose)
+    validation.printErrors(errors)
+    return errors
 
 
-def addProps(datamodel, nodedict, add_node=False):
+def getCDEInfo(cdeid, version=None, verbose=0, cadsrurl=cdecache.CADSR_URL):
+    if verbose >= 2:
+        print(f"caDSR CDE:\n{cdeid} {version}")
+    session = cdecache.cadsrSession(1)
+    cdeinfo = cdecache.fetchCDEInfo(session, cdeid, version, cadsrurl)
+    session.close()
+    if verbose >= 3:
+        print(f"Return caDSR info:\n{cdeinfo}")
+    if cdeinfo['cdedef'] is not None:
+        cdeinfo['cdedef'] = crdclib.cleanString(cdeinfo['cdedef'], True)
+    return cdeinfo
+
+
+
+def propInfo(node, row):
+    # The crdclib.mdfAddProperty entry for one sheet row, None if the row has no property.  row can be a Series or a dictionary
+    valtype = 'string'
+    req = 'No'
+    if pd.notnull(row['Description']):
+        description = crdclib.cleanString(str(row['Description']), True)
+        description = cleanHTML(description)
+    else:
+        description = None
+    if pd.notnull(row['Property']):
+        tempinfo = {}
+        propname = crdclib.cleanString(row['Property'], True)
+        propname = cleanHTML(propname)
+        propname = propname.lower()
+        if row['Required/optional'] == 'R':
+            req = 'Yes'
+        tempinfo = {'prop': propname, "_parent_handle": node, 'isreq': req, 'val': valtype, 'desc': description}
+        if row['Key'] == 'yes':
+            tempinfo['iskey'] = 'True'
+        return tempinfo
+    return None
+
+
+
+def addProps(builder, nodedict, add_node=False):
+    # builder is a modelbuilder.ModelBuilder, the Model is built from it once everything has been added
     node_prop_dict = {}
     edgelist = []
     for node, workign_df in nodedict.items():
         node_prop_dict[node] = []
         for index, row in workign_df.iterrows():
-            valtype = 'string'
-            req = 'No'
-            if pd.notnull(row['Description']):
-                description = crdclib.cleanString(str(row['Description']), True)
-                description = cleanHTML(description)
-            else:
-                description = None
-            if pd.notnull(row['Property']):
-                tempinfo = {}
-                propname = crdclib.cleanString(row['Property'], True)
-                propname = cleanHTML(propname)
-                propname = propname.lower()
-                if row['Required/optional'] == 'R':
-                    req = 'Yes'
-                tempinfo = {'prop': propname, "_parent_handle": node, 'isreq': req, 'val': valtype, 'desc': description}
-                if row['Key'] == 'yes':
-                    tempinfo['iskey'] = 'True'
+            tempinfo = propInfo(node, row)
+            if tempinfo is not None:
                 node_prop_dict[node].append(tempinfo)
-    datamodel = crdclib.mdfAddProperty(datamodel, node_prop_dict, False)
-    return datamodel, edgelist
-
-
+    if add_node:
+        builder.addNodes(list(node_prop_dict.keys()))
+    builder.addProperties(node_prop_dict)
+    return builder, edgelist
+
+
+
+def addTermRow(builder, nodename, row, verbose=0, cdelookup=None):
+    # Adds the CDE term or the enums from one sheet row.  cdelookup is the {cdeid: cdeinfo} table from cdecache.resolveCDEs.  Without it the CDE is fetched on its own.
+    if 'CDE' in row:
+        if pd.notnull(row['CDE']):
+            if cdelookup is not None:
+                cdeinfo = cdelookup.get(cdecache.cleanCDEID(row['CDE']))
+                if cdeinfo is None:
+                    if verbose >= 2:
+                        print(f"No CDE information for {row['CDE']}, skipping")
+                    return builder
+            else:
+                cdeinfo = crdclib.getCDEInfo(row['CDE'])
+            if cdeinfo['cdedef'] is not None:
+                cdedef = crdclib.cleanString(cdeinfo['cdedef'],True)
+                cdedef = cleanHTML(cdedef)
+            else:
+                cdedef = None
+            cdeid = str(row['CDE'])
+            # For some reason, IDs out of Excel are formated like a float
+            cdeid = cdeid.split(".")[0]
+            termvalues = {'handle': row['Property'].lower(), 'value': cdeinfo['cdename'], 'origin_version': cdeinfo['cdever'], 'origin_name':'caDSR', 'origin_id':cdeid, 'origin_definition': cdedef, 'nanoid': 'cdeurl'}
+            builder.annotate(nodename, row['Property'], termvalues)
+        elif 'Permissible values' in row:
+            if pd.notnull(row['Permissible values']):
+              pvlist = row['Permissible values'].split("\n")
+              builder.addEnums(nodename, row['Property'], pvlist)
+    return builder
 
 
 
-def addTerms(datamodel, nodedict, verbose=0):
+def addTerms(builder, nodedict, verbose=0, cdelookup=None):
     for nodename, working_df in nodedict.items():
         for index, row in working_df.iterrows():
-            if 'CDE' in row:
-                if pd.notnull(row['CDE']):
-                    cdeinfo = crdclib.getCDEInfo(row['CDE'])
-                    if cdeinfo['cdedef'] is not None:
-                        cdedef = crdclib.cleanString(cdeinfo['cdedef'],True)
-                        cdedef = cleanHTML(cdedef)
-                    else:
-                        cdedef = None
-                    cdeid = str(row['CDE'])
-                    # For some reason, IDs out of Excel are formated like a float
-                    cdeid = cdeid.split(".")[0]
-                    termvalues = {'handle': row['Property'].lower(), 'value': cdeinfo['cdename'], 'origin_version': cdeinfo['cdever'], 'origin_name':'caDSR', 'origin_id':cdeid, 'origin_definition': cdedef, 'nanoid': 'cdeurl'}
-                    datamodel = crdclib.mdfAnnotateTerms(datamodel, nodename, row['Property'], termvalues)
-                elif 'Permissible values' in row:
-                    if pd.notnull(row['Permissible values']):
-                      pvlist = row['Permissible values'].split("\n")
-                      datamodel = crdclib.mdfAddEnums(mdfmodel=datamodel, nodename=nodename, propname=row['Property'], enumlist=pvlist)
-    return datamodel
-
-
-
-def writeFiles(mdf, configs, verbose=0):
-    # This writes out the separate mode, property, etc., if reuested in the config.
-    jsonobj = json.dumps(MDFWriter(mdf).mdf)
-    mdfdict = json.loads(jsonobj)
-
-    if len(configs['mdffiles']) >= 1:
-        for entry in configs['mdffiles']:
-            for mdfsection, filename in entry.items():
-                if mdfsection != 'Model':
-                    if verbose >= 1:
-                        print(f"Writing file {entry}")
-                    printnode = {}
-                    printnode[mdfsection] = mdfdict.pop(mdfsection, None)
-                    crdclib.writeYAML(configs['workingpath']+filename, printnode)
-    #After printing out the requested sections, print out what's left
-    for entry in configs['mdffiles']:
-        for mdfsection, filename in entry.items():
-            if mdfsection == 'Model':
-                crdclib.writeYAML(configs['workingpath']+filename, mdfdict)
-
-
-
-def addEdges(datamodel, edgelist, verbose=0):
+            builder = addTermRow(builder, nodename, row, verbose, cdelookup)
+    return builder
+
+
+
+def writeFiles(mdf, configs, verbose=0, mdfdict=None):
+    # This writes out the separate mode, property, etc., if reuested in the config.  Pass mdfdict if MDFWriter has already been run on mdf.
+    if mdfdict is None:
+        mdfdict = bento_mdf.MDFWriter(mdf).mdf
+    if configs.get('sharding'):
+        return writeShards(mdfdict, mdfoutput.nodeTerms(mdf), configs, verbose)
+    return writeMDFDict(mdfdict, configs, verbose)
+
+
+
+def shardPath(configs):
+    return configs.get('shardpath', configs['workingpath']+'shards/')
+
+
+
+def writeShards(mdfdict, nodeterms, configs, verbose=0):
+    # Sharded output, one file per node or per sharding properties if sharding is a number
+    shardsize = None if configs['sharding'] == 'node' else int(configs['sharding'])
+    if configs.get('sharedenums'):
+        instrument.count('enum_lists', mdfoutput.shareEnums(mdfdict))
+    return mdfoutput.writeShardedMDF(mdfdict, nodeterms, shardPath(configs), configs['handle'], shardsize, configs.get('output_workers'), verbose)
+
+
+
+def writeMDFDict(mdfdict, configs, verbose=0):
+    # Writes an MDF dictionary out to the files in mdffiles, the Model file gets whatever sections are left.  Files that already have the right content
+    # aren't rewritten.  Returns {filename: fingerprint}
+    if configs.get('sharedenums'):
+        instrument.count('enum_lists', mdfoutput.shareEnums(mdfdict))
+    outputs = [(configs['workingpath']+filename, section) for filename, section in mdfoutput.splitSections(mdfdict, configs['mdffiles'])]
+    return mdfoutput.writeSections(outputs, configs.get('output_workers'), configs.get('streamoutput', False), verbose)
+
+
+
+def addEdges(builder, edgelist, verbose=0):
     if verbose >= 2:
         print(f"Starting Edge list:\n{edgelist}")
     listofedges = []
@@ -155,18 +191,19 @@ def addEdges(datamodel, edgelist, verbose=0):
             listofedges.append({'handle':edge['handle'], 'multiplicity':edge['mul'], 'src': end['src'], 'dst':end['dst'], 'desc': edge['desc']})
     if verbose >= 2:
         print(f"Complete set of edges to add:\n{listofedges}")
-    datamodel = crdclib.mdfAddEdges(datamodel, listofedges)
-    return datamodel
+    builder.addEdges(listofedges)
+    return builder
 
 
 
-def addTags(datamodel, taglist, verbose=0):
+def addTags(builder, taglist, verbose=0):
     for tag in taglist:
         for tagname, tagvalue in tag.items():
             tagname = tagname.lower()
-            print(f"Datamodel: {datamodel}\nNode: {tag['node'].lower()}\n TagName: {tagname}\nTagValue: {tagvalue}\n")
-            datamodel = crdclib.mdfAddTags(datamodel, 'node', tag['node'].lower(), {'key':tagname, 'value':tagvalue})
-    return datamodel
+            print(f"Datamodel: {builder}\nNode: {tag['node'].lower()}\n TagName: {tagname}\nTagValue: {tagvalue}\n")
+            if not builder.addTag('node', tag['node'].lower(), {'key':tagname, 'value':tagvalue}):
+                print(f"Tag node {tag['node']} is not in the model, skipping")
+    return builder
 
 
 
@@ -232,63 +269,29 @@ def addTags(datamodel, taglist, verbose=0):
     return loadsheets'''
 
 
-        
-
-def main(args):
-    # Setup
-    if args.verbose >= 1:
-        print("Config and dictionary setup")
-    configs = crdclib.readYAML(args.configfile)
-    nodedict = {}
-
-    #Read the input file
-    if args.verbose >= 1:
-        print(f"Reading Excel file {configs['excelfile']}")
-    xlfile = pd.ExcelFile(configs['workingpath']+configs['excelfile'])
-
-    #Get the node names (sheet names)
-    if args.verbose >= 1:
-        print("Setting up node/dataframe dictionary")
-    for node in xlfile.sheet_names:
-        if node == configs['edgesheet']:
-            if args.verbose >= 2:
-                print('Populating edge_df')
-            edge_df = pd.read_excel(configs['workingpath']+configs['excelfile'], node)
-        elif node not in configs['excludetabs']:
-            temp_df = pd.read_excel(configs['workingpath']+configs['excelfile'], node)
-            nodedict[node.lower()] = temp_df
-    
-    # Create an empty model object
-    if args.verbose >= 1:
-        print("Setting up an empty model")
-    idc_mdf = Model(handle= configs['handle'], version= configs['version'])
 
-    # Add nodes
-    if args.verbose >= 1:
-        print('Adding nodes to the model')
-    idc_mdf = crdclib.mdfAddNodes(idc_mdf, list(nodedict.keys()))
 
-    print(f"Nodes from model: {idc_mdf.nodes.keys()}")
-    
-    # Add properties
-    if args.verbose >= 1:
-        print("Adding properties to the model")
-    idc_mdf, edgelist = addProps(idc_mdf, nodedict, False)
+def resolveNodeCDEs(configs, cdelist, args, fetched=None):
+    # Opens the CDE cache and resolves every CDE in cdelist, e.g. cdecache.collectCDEs(nodedict).  Returns the {cdeid: cdeinfo} lookup.
+    # A fetched dictionary gets {cdeid: time it was fetched} for the CDEs that ended up in the cache
+    cachefile = configs.get('cdecache', configs['workingpath']+'cdecache.sqlite')
+    ttl = configs.get('cdecache_ttl', cdecache.DEFAULT_TTL)
+    cacheconn = cdecache.openCDECache(cachefile)
+    pruned = cdecache.pruneCDECache(cacheconn, ttl)
+    if args.verbose >= 2:
+        print(f"Evicted {pruned} expired CDE cache entries from {cachefile}")
+    cdelookup = cdecache.resolveCDEs(cacheconn, cdelist, ttl=ttl, cacheonly=args.cache_only, refresh=args.refresh_cdes,
+                                     workers=configs.get('cde_workers', cdecache.DEFAULT_WORKERS), rate=configs.get('cde_rate', cdecache.DEFAULT_RATE),
+                                     cadsrurl=configs.get('cadsrurl', cdecache.CADSR_URL), verbose=args.verbose)
+    if fetched is not None:
+        fetched.update(cdecache.fetchedTimes(cacheconn, cdelist))
+    cacheconn.close()
+    return cdelookup
 
-    # Add terms
-    if args.verbose >= 1:
-        print('Adding CDE Terms to model')
-    idc_mdf = addTerms(idc_mdf, nodedict, args.verbose)
 
-    #Add node tags
-    if args.verbose >=1:
-        print('Adding tags to nodes')
-    if 'tags' in configs:
-        idc_mdf = addTags(idc_mdf, configs['tags'], args.verbose )
 
-    # Add edges
-    if args.verbose >= 1:
-        print("Adding edges to model")
+def buildEdgeList(edge_df):
+    # Turns the relationships sheet into the edge list used by addEdges
     edgelist = []
     for index, row in edge_df.iterrows():
         edgelist.append({
@@ -297,36 +300,534 @@ def main(args):
         'mul': row['Cardinality'],
         'ends': [{'src': row['Source node'].lower(), 'dst': row['Destination node'].lower()}]
         })
+    return edgelist
 
-    idc_mdf = addEdges(idc_mdf, edgelist, args.verbose)
 
-    # Write out the files
-    if args.verbose >= 1:
-        print(f"Writing out the MDF Files in {configs['workingpath']}")
-    writeFiles(idc_mdf, configs, args.verbose)
 
-    if args.verbose >= 1:
-        print("Validating final model")
+def mdfFileList(configs):
+    if configs.get('sharding'):
+        return mdfoutput.shardFiles(f"{shardPath(configs)}{configs['handle']}_shards.yml")
     filelist = []
     for fileentry in configs['mdffiles']:
         for filename in fileentry.values():
             filelist.append(f"{configs['workingpath']}{filename}")
-    validateModel(filelist)
+    return filelist
+
+
+
+def diffModel(mdfdict, configs, args):
+    # Changelog and patch MDF against the files the last run left.  Has to run before they're overwritten
+    if args.changelog is None and args.patch is None:
+        return None
+    oldfiles = []
+    if not configs.get('sharding') or os.path.exists(f"{shardPath(configs)}{configs['handle']}_shards.yml"):
+        oldfiles = mdfFileList(configs)
+    with instrument.stage('diff'):
+        return modeldiff.writeDiff(oldfiles, mdfdict, args.changelog, args.patch, f"{configs['handle']} {configs['version']}", args.verbose)
+
+
+
+def writeLoadSheets(sheets, configs, verbose=0):
+    # Writes {node: [columns]} in the configured loadsheetformat.  Returns {filename: fingerprint}
+    return loadsheets.writeLoadSheets(sheets, configs['loadsheetpath'], LOADSHEET_PREFIX, configs.get('loadsheetformat', 'tsv'), configs.get('output_workers'), verbose)
+
+
+
+def buildNodeFragment(configs, nodename, node_df, cdelookup, verbose=0, fetched=None):
+    # Builds one node in a model of its own and returns the pieces of MDF it contributes.  Used by incremental builds so unchanged nodes can be reused.
+    # fetched is {cdeid: time it was fetched} from resolveNodeCDEs.  The fragment keeps it for the node's CDEs, None for CDEs that weren't resolved
+    builder = modelbuilder.ModelBuilder(configs['handle'], configs['version'])
+    builder.addNodes([nodename])
+    builder, edgelist = addProps(builder, {nodename: node_df}, False)
+    builder = addTerms(builder, {nodename: node_df}, verbose, cdelookup)
+    return nodeFragment(configs, nodename, builder, cdecache.collectCDEs({nodename: node_df}), verbose, fetched)
+
+
+def nodeFragment(configs, nodename, builder, cdelist, verbose=0, fetched=None):
+    # The fragment for a node builder holding the node's properties and terms.  cdelist is the cleaned ids of the node's CDEs
+    if 'tags' in configs:
+        builder = addTags(builder, [tag for tag in configs['tags'] if tag['node'].lower() == nodename], verbose)
+    # With tablecache set the fragment also keeps the node's tables, so the cache can be rewritten without rebuilding unchanged nodes
+    tables = tablecache.builderTables(builder) if 'tablecache' in configs else None
+    node_mdf = builder.materialize()
+    mdfdict = bento_mdf.MDFWriter(node_mdf).mdf
+
+    # Load sheet columns in model order, same rules as crdclib.mdfBuildLoadSheets
+    columns = []
+    keys = []
+    for propname, propobj in node_mdf.nodes[nodename].props.items():
+        if 'Template' not in propobj.tags or propobj.tags['Template'].get_attr_dict()['value'] != 'No':
+            columns.append(propname)
+        if propobj.get_attr_dict().get('is_key') == 'True':
+            keys.append(propname)
+    # Terms are keyed the way the model keys them so merged fragments sort the same as a full build
+    terms = [[list(key), term.handle, mdfdict['Terms'][term.handle]] for key, term in node_mdf.terms.items()]
+    cdes = {cdeid: (fetched or {}).get(cdeid) for cdeid in cdelist}
+    fragment = {'Nodes': mdfdict['Nodes'][nodename], 'PropDefinitions': mdfdict['PropDefinitions'], 'Terms': terms, 'Columns': columns, 'Keys': keys, 'CDEs': cdes}
+    if tables is not None:
+        fragment['Tables'] = tables
+    return fragment
+
+
+def staleCDESheets(fragments, nodesheets, configs, args):
+    # Node sheets whose stored fragment has to be rebuilt for its CDEs even though the sheet didn't change: all of them with --refresh-cdes,
+    # and any with a CDE that wasn't resolved last time (--cache-only miss, caDSR error) or was fetched longer than cdecache_ttl days ago
+    ttl = configs.get('cdecache_ttl', cdecache.DEFAULT_TTL)
+    oldest = None if ttl is None else time.time() - ttl * 86400
+    stale = []
+    for sheet in nodesheets:
+        cdes = fragments.get(sheet.lower(), {}).get('CDEs', {})
+        if len(cdes) == 0:
+            continue
+        if args.refresh_cdes or any(fetched is None or (oldest is not None and fetched < oldest) for fetched in cdes.values()):
+            stale.append(sheet)
+    return stale
+
+
+
+def mergeFragments(edge_mdf, fragments):
+    # Assembles the full MDF dictionary from the per-node fragments and a model holding just the nodes and edges
+    mdfdict = bento_mdf.MDFWriter(edge_mdf).mdf
+    terms = {}
+    for nodename in sorted(fragments):
+        mdfdict['Nodes'][nodename] = fragments[nodename]['Nodes']
+        mdfdict['PropDefinitions'].update(fragments[nodename]['PropDefinitions'])
+        for key, handle, spec in fragments[nodename]['Terms']:
+            terms[tuple('' if part is None else part for part in key)] = (handle, spec)
+    for key in sorted(terms):
+        handle, spec = terms[key]
+        mdfdict['Terms'][handle] = spec
+    return mdfdict
+
+
+
+def csvFingerprints(configs):
+    # {node: content hash} of each node's rows in csvfile, what workbook.sheetFingerprints gives for the node tabs
+    digests = {}
+    for nodename, rows in nodeRows(configs):
+        digest = digests.setdefault(nodename, hashlib.sha256())
+        for row in rows:
+            digest.update(json.dumps(list(row.values()), default=str).encode())
+    return {nodename: digest.hexdigest() for nodename, digest in digests.items()}
+
+
+def streamFragments(configs, args, nodelist):
+    # --stream version of the incremental node rebuild: the rows of the nodes in nodelist go straight into one builder per node, the
+    # same way streamBuild does it, and only the (property, CDE) pairs are kept until the CDEs are resolved.  Returns {node: fragment}
+    builders = {}
+    cderows = {}
+    with instrument.stage('stream_model'):
+        for nodename, rows in nodeRows(configs):
+            if nodename not in nodelist:
+                continue
+            if nodename not in builders:
+                builders[nodename] = modelbuilder.ModelBuilder(configs['handle'], configs['version'])
+                builders[nodename].addNodes([nodename])
+                cderows[nodename] = []
+            builder = builders[nodename]
+            for row in rows:
+                instrument.count('rows')
+                tempinfo = propInfo(nodename, row)
+                if tempinfo is not None:
+                    builder.addProperties({nodename: [tempinfo]})
+                if pd.notnull(row.get('CDE')):
+                    cderows[nodename].append((row['Property'], row['CDE']))
+                else:
+                    builder = addTermRow(builder, nodename, row, args.verbose)
+    fragments = {}
+    if len(builders) > 0:
+        with instrument.stage('cde_resolution'):
+            fetched = {}
+            cdelookup = resolveNodeCDEs(configs, list(dict.fromkeys(cdecache.cleanCDEID(cdeid) for rows in cderows.values() for propname, cdeid in rows)), args, fetched)
+        with instrument.stage('build_model'):
+            for nodename, builder in builders.items():
+                for propname, cdeid in cderows[nodename]:
+                    builder = addTermRow(builder, nodename, {'Property': propname, 'CDE': cdeid}, args.verbose, cdelookup)
+                cdelist = list(dict.fromkeys(cdecache.cleanCDEID(cdeid) for propname, cdeid in cderows[nodename]))
+                fragments[nodename] = nodeFragment(configs, nodename, builder, cdelist, args.verbose, fetched)
+    return fragments
+
+
+def incrementalBuild(configs, args):
+    # Only nodes whose worksheet (or the config) changed since the last run are rebuilt, everything else comes from the manifest
+    manifestfile = incremental.manifestFile(configs, '.idc2mdf_manifest.json')
+    manifest = incremental.readManifest(manifestfile)
+    excelfile = configs['workingpath']+configs['excelfile']
+    with instrument.stage('fingerprint'):
+        fingerprints = workbook.sheetFingerprints(excelfile)
+        for sheet in configs['excludetabs']:
+            fingerprints.pop(sheet, None)
+        if args.stream and 'csvfile' in configs:
+            # The node rows come from csvfile, only the relationships from the workbook
+            fingerprints = dict(csvFingerprints(configs), **{configs['edgesheet']: fingerprints[configs['edgesheet']]})
+        confighash = incremental.configFingerprint(configs)
+        changed = incremental.changedSheets(manifest, fingerprints, confighash)
+    nodesheets = [sheet for sheet in fingerprints if sheet != configs['edgesheet']]
+    changed = changed + [sheet for sheet in staleCDESheets(manifest['fragments'], nodesheets, configs, args) if sheet not in changed]
+    instrument.count('changed_sheets', len(changed))
+    removed = [node for node in manifest['fragments'] if node not in [sheet.lower() for sheet in nodesheets]]
+    if len(changed) == 0 and len(removed) == 0 and incremental.outputsCurrent(manifest):
+        if args.verbose >= 1:
+            print("Model is up to date, nothing to rebuild")
+        return
+    if args.verbose >= 1:
+        print(f"Rebuilding sheets: {changed}")
+        if len(removed) > 0:
+            print(f"Removing nodes: {removed}")
+
+    fragments = manifest['fragments']
+    for node in removed:
+        fragments.pop(node)
+    if args.stream:
+        fragments.update(streamFragments(configs, args, [sheet.lower() for sheet in changed if sheet != configs['edgesheet']]))
+        with instrument.stage('excel'):
+            edge_df = pd.DataFrame(list(workbook.iterRows(excelfile, configs['edgesheet'])))
+        nodedict = {}
+    else:
+        with instrument.stage('excel'):
+            xlfile = workbook.openWorkbook(excelfile, configs.get('excelengine'))
+            edge_df = workbook.readSheet(xlfile, configs['edgesheet'])
+            nodedict = {}
+            for node in changed:
+                if node != configs['edgesheet']:
+                    nodedict[node.lower()] = workbook.readSheet(xlfile, node, workbook.IDC_COLUMNS)
+                    instrument.count('rows', len(nodedict[node.lower()]))
+            xlfile.close()
+    if len(nodedict) > 0:
+        with instrument.stage('cde_resolution'):
+            fetched = {}
+            cdelookup = resolveNodeCDEs(configs, cdecache.collectCDEs(nodedict), args, fetched)
+        with instrument.stage('build_model'):
+            for nodename, node_df in nodedict.items():
+                fragments[nodename] = buildNodeFragment(configs, nodename, node_df, cdelookup, args.verbose, fetched)
+
+    with instrument.stage('build_edges'):
+        # Edges only need the nodes themselves, not their properties
+        builder = modelbuilder.ModelBuilder(configs['handle'], configs['version'])
+        builder.addNodes([sheet.lower() for sheet in nodesheets])
+        edge_mdf = addEdges(builder, buildEdgeList(edge_df), args.verbose).materialize()
+    if 'tablecache' in configs:
+        with instrument.stage('tablecache'):
+            # Same tables a full build saves: the node tables of every fragment, in sheet order, plus the nodes, edges and edge tags
+            nodetables = [{name: table for name, table in fragments[sheet.lower()]['Tables'].items() if name != 'nodes'} for sheet in nodesheets]
+            tablecache.writeTables(tablecache.mergeTables([tablecache.builderTables(builder)] + nodetables), configs['tablecache'],
+                                   configs.get('tablecacheformat', 'feather'), handle=configs['handle'], version=configs['version'], source=configs['excelfile'])
+    with instrument.stage('serialize'):
+        mdfdict = mergeFragments(edge_mdf, fragments)
+    diffModel(mdfdict, configs, args)
+
+    if args.verbose >= 1:
+        print("Validating final model")
+    with instrument.stage('validation'):
+        instrument.count('validation_errors', len(validateModel(mdfdict, configs, args.verbose)))
+
+    if args.verbose >= 1:
+        print(f"Writing out the MDF Files in {configs['workingpath']}")
+    with instrument.stage('write'):
+        if configs.get('sharding'):
+            nodeterms = {nodename: [term[1] for term in fragment['Terms']] for nodename, fragment in fragments.items()}
+            outputs = writeShards(mdfdict, nodeterms, configs, args.verbose)
+        else:
+            outputs = writeMDFDict(mdfdict, configs, args.verbose)
+    if args.revalidate and outputs != manifest['outputs']:
+        with instrument.stage('revalidate'):
+            revalidateFiles(configs, args.verbose)
+
+    if configs['loadsheetpath'] is not None:
+        with instrument.stage('loadsheets'):
+            # Columns come from the stored fragments, so unchanged nodes don't need rebuilding.  Only sheets whose columns changed are rewritten
+            columns = {nodename: fragments[nodename]['Columns'] for nodename in edge_mdf.nodes}
+            keys = {nodename: fragments[nodename]['Keys'] for nodename in edge_mdf.nodes}
+            sheets = loadsheets.sheetColumns(columns, keys, loadsheets.edgeIndex(edge_mdf), reverse=False, typecolumn=True)
+            outputs.update(writeLoadSheets(sheets, configs, args.verbose))
+            instrument.count('loadsheets', len(sheets))
+
+    manifest['config'] = confighash
+    manifest['sheets'] = fingerprints
+    manifest['fragments'] = fragments
+    manifest['outputs'] = outputs
+    incremental.writeManifest(manifestfile, manifest)
+
+
+
+def finishModel(idc_mdf, configs, args):
+    # Everything after the model is built: validation, the MDF files and the load sheets
+    instrument.count('nodes', len(idc_mdf.nodes))
+    instrument.count('props', len(idc_mdf.props))
+    instrument.count('terms', len(idc_mdf.terms))
+    instrument.count('edges', len(idc_mdf.edges))
+
+    with instrument.stage('serialize'):
+        mdfdict = bento_mdf.MDFWriter(idc_mdf).mdf
+    if args.verbose >= 1:
+        print("Validating final model")
+    with instrument.stage('validation'):
+        instrument.count('validation_errors', len(validateModel(mdfdict, configs, args.verbose)))
+
+    diffModel(mdfdict, configs, args)
+
+    # Write out the files
+    if args.verbose >= 1:
+        print(f"Writing out the MDF Files in {configs['workingpath']}")
+    with instrument.stage('write'):
+        instrument.count('output_files', len(writeFiles(idc_mdf, configs, args.verbose, mdfdict)))
+    if args.revalidate:
+        with instrument.stage('revalidate'):
+            revalidateFiles(configs, args.verbose)
 
     if configs['loadsheetpath'] is not None:
         if args.verbose >= 1:
             print(f"Writing data load sheets in {configs['loadsheetpath']}")
-        load_df = crdclib.mdfBuildLoadSheets(idc_mdf, reverse=False, typecolumn=True)
-        for node, loadsheet_df in load_df.items():
-            filename = f"{configs['loadsheetpath']}NCI_Imaging_Data_Loading_Template_{node}.tsv"
-            loadsheet_df.to_csv(filename, sep="\t", index=False)
+        with instrument.stage('loadsheets'):
+            sheets = loadsheets.buildLoadSheets(idc_mdf, reverse=False, typecolumn=True)
+            writeLoadSheets(sheets, configs, args.verbose)
+            instrument.count('loadsheets', len(sheets))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+
+def finishBuilder(builder, configs, args):
+    # Saves the staged tables if tablecache is set, then builds the Model and writes everything out
+    if 'tablecache' in configs and not args.from_cache:
+        with instrument.stage('tablecache'):
+            tablecache.writeTables(tablecache.builderTables(builder), configs['tablecache'], configs.get('tablecacheformat', 'feather'),
+                                   handle=configs['handle'], version=configs['version'], source=configs['csvfile'] if args.stream and 'csvfile' in configs else configs['excelfile'])
+    with instrument.stage('materialize'):
+        idc_mdf = builder.materialize()
+    finishModel(idc_mdf, configs, args)
+
+
+
+def cachedBuild(configs, args):
+    # --from-cache: the model comes from the tables a previous run saved in tablecache, the workbook and caDSR aren't touched
+    if 'tablecache' not in configs:
+        print("--from-cache needs tablecache set in the config")
+        return
+    with instrument.stage('tablecache'):
+        tables, meta = tablecache.readTables(configs['tablecache'])
+    if args.verbose >= 1:
+        print(f"Building from the tables cached from {meta.get('source')} at {time.ctime(meta['written'])}")
+    builder = tablecache.loadBuilder(modelbuilder.ModelBuilder(configs['handle'], configs['version']), tables)
+    finishBuilder(builder, configs, args)
+
+
+
+def nodeRows(configs, usecsv=True):
+    # Generator of (nodename, rows) read a row at a time.  Rows come from csvfile if it's set and usecsv (one CSV of every node's properties, with a
+    # Node column), otherwise from the node tabs of the workbook.  Each node's rows have to be used before asking for the next node
+    if usecsv and 'csvfile' in configs:
+        for row in workbook.iterRows(configs['workingpath']+configs['csvfile'], columns=workbook.IDC_COLUMNS+[CSV_NODE_COLUMN]):
+            nodename = row.pop(CSV_NODE_COLUMN)
+            if nodename is not None:
+                yield str(nodename).lower(), [row]
+    else:
+        for sheetname, rows in workbook.iterSheetRows(configs['workingpath']+configs['excelfile'], configs['excludetabs']+[configs['edgesheet']], workbook.IDC_COLUMNS):
+            yield sheetname.lower(), rows
+
+
+
+def streamBuild(configs, args):
+    # Builds the model without any node DataFrames.  Each row goes straight into the builder, rows with a CDE are only kept as
+    # (node, property, CDE id) until every CDE is known and can be resolved in one go
+    builder = modelbuilder.ModelBuilder(configs['handle'], configs['version'])
+    cderows = []
+    if args.verbose >= 1:
+        print("Streaming node properties into the model")
+    with instrument.stage('stream_model'):
+        for nodename, rows in nodeRows(configs):
+            builder.addNodes([nodename])
+            for row in rows:
+                instrument.count('rows')
+                tempinfo = propInfo(nodename, row)
+                if tempinfo is not None:
+                    builder.addProperties({nodename: [tempinfo]})
+                if pd.notnull(row.get('CDE')):
+                    cderows.append((nodename, row['Property'], row['CDE']))
+                else:
+                    builder = addTermRow(builder, nodename, row, args.verbose)
+
+    if args.verbose >= 1:
+        print('Resolving CDEs')
+    with instrument.stage('cde_resolution'):
+        cdelookup = resolveNodeCDEs(configs, list(dict.fromkeys(cdecache.cleanCDEID(cderow[2]) for cderow in cderows)), args)
+
+    with instrument.stage('build_terms'):
+        for nodename, propname, cdeid in cderows:
+            builder = addTermRow(builder, nodename, {'Property': propname, 'CDE': cdeid}, args.verbose, cdelookup)
+        if 'tags' in configs:
+            builder = addTags(builder, configs['tags'], args.verbose)
+
+    with instrument.stage('build_edges'):
+        edge_df = pd.DataFrame(list(workbook.iterRows(configs['workingpath']+configs['excelfile'], configs['edgesheet'])))
+        builder = addEdges(builder, buildEdgeList(edge_df), args.verbose)
+
+    finishBuilder(builder, configs, args)
+
+
+
+def planBuild(configs, args):
+    # --plan: counts what a full build would produce from the rows alone, checks the CDE cache and lists the output files
+    nodes = {}
+    enums = {}
+    cdeprops = set()
+    cdelist = {}
+    for nodename, rows in nodeRows(configs, args.stream):
+        props = nodes.setdefault(nodename, {})
+        for row in rows:
+            tempinfo = propInfo(nodename, row)
+            if tempinfo is not None:
+                props.setdefault(tempinfo['prop'], None)
+            # Every CDE in the tabs is resolved, the same as collectCDEs and streamBuild do.  Only the properties addTermRow finds by
+            # their name as written in the sheet get the term
+            if row.get('CDE') is not None:
+                cdelist.setdefault(cdecache.cleanCDEID(row['CDE']), None)
+                if row['Property'] in props:
+                    cdeprops.add((nodename, row['Property']))
+            elif row.get('Permissible values') is not None and row['Property'] in props:
+                enums.setdefault((nodename, row['Property']), set()).update(row['Permissible values'].split("\n"))
+    edges = set()
+    for row in workbook.iterRows(configs['workingpath']+configs['excelfile'], configs['edgesheet']):
+        src = str(row['Source node']).lower()
+        dst = str(row['Destination node']).lower()
+        if src in nodes and dst in nodes:
+            edges.add((f"of_{dst}", src, dst))
+
+    counts = {'nodes': len(nodes), 'properties': sum(len(props) for props in nodes.values()), 'enum properties': len(enums),
+              'distinct enum values': len(set().union(*enums.values())), 'CDE annotated properties': len(cdeprops), 'edges': len(edges)}
+    ttl = configs.get('cdecache_ttl', cdecache.DEFAULT_TTL)
+    cached = 0 if args.refresh_cdes else runplan.cachedCDEs(configs.get('cdecache', configs['workingpath']+'cdecache.sqlite'), list(cdelist), ttl)
+    cdes = {'total': len(cdelist), 'cached': cached, 'fetch': 0 if args.cache_only else len(cdelist) - cached, 'rate': configs.get('cde_rate', cdecache.DEFAULT_RATE)}
+
+    if configs.get('sharding'):
+        files = runplan.shardFileList(shardPath(configs), configs['handle'], {nodename: list(props) for nodename, props in nodes.items()}, configs['sharding'])
+    else:
+        files = mdfFileList(configs)
+    if configs['loadsheetpath'] is not None:
+        loadsheetfiles = loadsheets.loadSheetFiles(nodes, configs['loadsheetpath'], LOADSHEET_PREFIX, configs.get('loadsheetformat', 'tsv'))
+        counts['load sheets'] = len(nodes)
+        files = files + list(loadsheetfiles.values())
+    for extra in [args.changelog, args.patch]:
+        if extra is not None and extra != '-':
+            files.append(extra)
+    runplan.printPlan(f"{configs['handle']} {configs['version']}", counts, files, cdes)
+    return counts
+
+
+
+def main(args, configs=None):
+    # Setup
+    if args.verbose >= 1:
+        print("Config and dictionary setup")
+    # configs can be passed in already loaded, e.g. by batch2mdf.py
+    if configs is None:
+        with instrument.stage('config'):
+            configs = crdclib.readYAML(args.configfile)
+    nodedict = {}
+    if args.plan:
+        planBuild(configs, args)
+        return
+    if args.from_cache:
+        cachedBuild(configs, args)
+        return
+    if args.incremental:
+        incrementalBuild(configs, args)
+        return
+    if args.stream:
+        streamBuild(configs, args)
+        return
+
+    #Read the input file
+    if args.verbose >= 1:
+        print(f"Reading Excel file {configs['excelfile']}")
+    with instrument.stage('excel'):
+        xlfile = workbook.openWorkbook(configs['workingpath']+configs['excelfile'], configs.get('excelengine'))
+
+        #Get the node names (sheet names)
+        if args.verbose >= 1:
+            print("Setting up node/dataframe dictionary")
+        if args.verbose >= 2:
+            print('Populating edge_df')
+        edge_df = workbook.readSheet(xlfile, configs['edgesheet'])
+        for node, temp_df in workbook.iterSheets(xlfile, configs['excludetabs']+[configs['edgesheet']], workbook.IDC_COLUMNS):
+            nodedict[node.lower()] = temp_df
+            instrument.count('rows', len(temp_df))
+        xlfile.close()
+    
+    with instrument.stage('build_model'):
+        # Create an empty model object.  Everything is staged in the builder and the Model is built at the end
+        if args.verbose >= 1:
+            print("Setting up an empty model")
+        builder = modelbuilder.ModelBuilder(configs['handle'], configs['version'])
+
+        # Add nodes
+        if args.verbose >= 1:
+            print('Adding nodes to the model')
+        builder.addNodes(list(nodedict.keys()))
+
+        print(f"Nodes from model: {builder.nodes.keys()}")
+    
+        # Add properties
+        if args.verbose >= 1:
+            print("Adding properties to the model")
+        builder, edgelist = addProps(builder, nodedict, False)
+
+    # Resolve all the CDEs up front
+    if args.verbose >= 1:
+        print('Resolving CDEs')
+    with instrument.stage('cde_resolution'):
+        cdelookup = resolveNodeCDEs(configs, cdecache.collectCDEs(nodedict), args)
+
+    with instrument.stage('build_terms'):
+        # Add terms
+        if args.verbose >= 1:
+            print('Adding CDE Terms to model')
+        builder = addTerms(builder, nodedict, args.verbose, cdelookup)
+
+        #Add node tags
+        if args.verbose >=1:
+            print('Adding tags to nodes')
+        if 'tags' in configs:
+            builder = addTags(builder, configs['tags'], args.verbose )
+
+    with instrument.stage('build_edges'):
+        # Add edges
+        if args.verbose >= 1:
+            print("Adding edges to model")
+        edgelist = buildEdgeList(edge_df)
+
+        builder = addEdges(builder, edgelist, args.verbose)
+
+    finishBuilder(builder, configs, args)
+
+
+def addArguments(parser):
+    # The command line options, shared with mdfconvert.py
     parser.add_argument("-c", "--configfile", required=True,  help="Configuration file containing all the input info")
     parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
+    parser.add_argument('--refresh-cdes', action='store_true', help="Ignore cached CDE entries and requery caDSR")
+    parser.add_argument('--cache-only', action='store_true', help="Offline mode, only use CDE information already in the cache")
+    parser.add_argument('--revalidate', action='store_true', help="After writing, parse the MDF files again and validate them as written")
+    parser.add_argument('--incremental', action='store_true', help="Only rebuild nodes whose worksheet changed since the last incremental run")
+    parser.add_argument('--stream', action='store_true', help="Read the node tabs (or csvfile) a row at a time instead of keeping a DataFrame per node")
+    parser.add_argument('--plan', action='store_true', help="Only report what a run would do: counts, CDEs already cached, caDSR requests and the files written.  Nothing is built or written")
+    parser.add_argument('--from-cache', action='store_true', help="Build from the tables saved in tablecache by an earlier run instead of the workbook.  No caDSR lookups")
+    parser.add_argument('--changelog', help="Compare the new model to the MDF files from the last run and write a changelog to this file ('-' for stdout)")
+    parser.add_argument('--patch', help="Write an MDF file holding only the entries added or changed since the last run")
+    parser.add_argument('--stats', help="Write per-stage timings, counts and peak memory to this JSON file ('-' for stdout)")
+    parser.add_argument('--profile', help="Write a profile of the run to this file.  .html uses pyinstrument if installed, otherwise a cProfile dump")
+    return parser
+
+
+def run(args):
+    # main() with the --stats and --profile handling
+    if args.stats is not None:
+        instrument.enable(script='IDC2MDF', configfile=args.configfile)
+    if args.profile is not None:
+        instrument.profiled(main, args.profile, args)
+    else:
+        main(args)
+    if args.stats is not None:
+        instrument.writeReport(args.stats)
 
-    args = parser.parse_args()
 
-    main(args)
+if __name__ == "__main__":
+    run(addArguments(argparse.ArgumentParser()).parse_args())
@@ -0,0 +1,144 @@
+# Converts several models in one process.  pandas, bento_meta, bento_mdf and jsonschema are imported once, the MDF schema is compiled once per
+# schema file and shared, and with --cdecache every model uses the same CDE cache.  Models are converted concurrently by a pool of workers.
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import CIDC2MDF
+import IDC2MDF
+import configcheck
+import instrument
+import validation
+
+CONVERTERS = {'cidc': CIDC2MDF, 'idc': IDC2MDF}
+
+
+def jobArgs(args, configfile):
+    # The argparse namespace the converter mains expect
+    return argparse.Namespace(configfile=configfile, verbose=args.verbose, incremental=args.incremental or args.watch is not None, refresh_cdes=args.refresh_cdes,
+                              cache_only=args.cache_only, revalidate=args.revalidate, stream=args.stream,
+                              plan=args.plan, from_cache=args.from_cache, changelog=None, patch=None, stats=None, profile=None)
+
+
+def loadJobs(args):
+    # [(converter name, config file, configs)] with the batch wide overrides applied
+    jobs = []
+    for configfile in args.configfiles:
+        if not os.path.exists(configfile):
+            print(f"Config file {configfile} not found.  Skipping")
+            continue
+        configs = configcheck.readConfig(configfile)
+        name = configcheck.converterName(configs)
+        if name not in CONVERTERS:
+            print(f"Can't tell which converter {configfile} is for, add 'converter: cidc' or 'converter: idc' to it.  Skipping")
+            continue
+        if name == 'idc':
+            if args.cdecache is not None:
+                configs['cdecache'] = args.cdecache
+            if args.mdfschema is not None:
+                configs['mdfschema'] = args.mdfschema
+        jobs.append((name, configfile, configs))
+    return jobs
+
+
+def runJob(job, args):
+    # Runs one conversion.  Returns (config file, seconds, error message or None) so one failed model doesn't stop the others
+    name, configfile, configs = job
+    start = time.perf_counter()
+    try:
+        CONVERTERS[name].main(jobArgs(args, configfile), configs)
+    except Exception as e:
+        return configfile, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return configfile, time.perf_counter() - start, None
+
+
+def prewarm(jobs, verbose=0):
+    # Compiles each MDF schema before the workers start so they all share it.  Forked worker processes inherit it too.  Schemas compiled
+    # on an earlier --watch pass are already there
+    for name, configfile, configs in jobs:
+        if name == 'idc':
+            schemafile = IDC2MDF.schemaFile(configs)
+            if schemafile in validation.VALIDATORS:
+                continue
+            if validation.schemaValidator(schemafile) is not None and verbose >= 1:
+                print(f"Compiled MDF schema {schemafile}")
+
+
+def workerPool(workers, processes=False):
+    # Threads share everything in memory.  Processes are forked so they start with the modules and schemas already loaded, and share the CDE cache through its SQLite file
+    if processes and 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    if processes:
+        print("fork isn't available on this platform, using threads")
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def runBatch(jobs, args):
+    # Converts every job and prints a summary.  Returns the number of failed jobs
+    failed = 0
+    with workerPool(args.workers, args.processes) as pool:
+        futures = [pool.submit(runJob, job, args) for job in jobs]
+        for future in futures:
+            configfile, seconds, error = future.result()
+            if error is None:
+                print(f"{configfile}: done in {seconds:.1f} s")
+            else:
+                failed = failed + 1
+                print(f"{configfile}: failed after {seconds:.1f} s, {error}")
+    return failed
+
+
+def main(args):
+    while True:
+        # The configs are read again on every --watch pass, so edits to them are picked up
+        jobs = loadJobs(args)
+        if len(jobs) == 0 and args.watch is None:
+            return 1
+        if not args.plan:
+            prewarm(jobs, args.verbose)
+        start = time.perf_counter()
+        failed = runBatch(jobs, args)
+        print(f"Converted {len(jobs) - failed} of {len(jobs)} models in {time.perf_counter() - start:.1f} s")
+        if args.watch is None:
+            return 1 if failed > 0 else 0
+        # Watch mode runs incrementally, so models whose workbook and config haven't changed are skipped on the next pass
+        time.sleep(args.watch)
+
+
+def addArguments(parser):
+    # The command line options, shared with mdfconvert.py
+    parser.add_argument("-c", "--configfiles", required=True, nargs='+', help="Configuration files of the models to convert, CIDC2MDF or IDC2MDF configs")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Number of models converted at the same time.  Default is one per model, up to the CPU count")
+    parser.add_argument('--processes', action='store_true', help="Use forked worker processes instead of threads, so CPU bound conversions run in parallel")
+    parser.add_argument('--cdecache', help="CDE cache file shared by every IDC model, instead of each model's own")
+    parser.add_argument('--mdfschema', help="MDF schema file shared by every IDC model, instead of each model's own")
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help="Keep running, reconverting changed models every SECONDS")
+    parser.add_argument('--incremental', action='store_true', help="Passed on to the converters")
+    parser.add_argument('--plan', action='store_true', help="Passed on to the converters, each model's plan is printed and nothing is converted")
+    parser.add_argument('--stream', action='store_true', help="Passed on to the converters")
+    parser.add_argument('--from-cache', action='store_true', help="Passed on to the converters")
+    parser.add_argument('--refresh-cdes', action='store_true', help="Passed on to IDC2MDF.py")
+    parser.add_argument('--cache-only', action='store_true', help="Passed on to IDC2MDF.py")
+    parser.add_argument('--revalidate', action='store_true', help="Passed on to IDC2MDF.py")
+    parser.add_argument('--stats', help="Write the combined per-stage timings and counts of all the models to this JSON file ('-' for stdout).  Thread workers only")
+    return parser
+
+
+def run(args):
+    # main() with the --stats handling.  Returns the exit status
+    if args.workers is None:
+        args.workers = min(len(args.configfiles), os.cpu_count() or 1)
+
+    if args.stats is not None:
+        instrument.enable(script='batch2mdf', configfiles=args.configfiles)
+    status = main(args)
+    if args.stats is not None:
+        instrument.writeReport(args.stats)
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(run(addArguments(argparse.ArgumentParser()).parse_args()))
@@ -0,0 +1,248 @@
+# End to end benchmark of both converters on synthetic workbooks.  Generates a CIDC gap analysis workbook (single sheet, columns G:K, header on row 9)
+# and an IDC workbook (one tab per node plus the relationships tab), runs CIDC2MDF.main and IDC2MDF.main on them with caDSR stubbed out, and reports the
+# per-stage timings and memory from instrument.py.  Each run is a separate process so peak memory is per run.
+# Usage: python benchmarks/bench_converters.py -n 50 -p 100 -r 3 -o results.json
+#        python benchmarks/bench_converters.py -n 50 -p 100 -b results.json      (compare against an earlier run)
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import pandas as pd
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATATYPES = ['string', 'integer', 'number', 'boolean', 'date']
+CIDC_HEADER = ['Node', 'Property', 'Data Type', 'Permissible Value', 'Notes.1']
+IDC_EDGESHEET = 'Relationships between nodes'
+
+
+def nodeNames(nodecount):
+    return [f"Node{n:04d}" for n in range(nodecount)]
+
+
+def pvList(rng, pvcount):
+    return [f"Value {rng.randrange(pvcount * 4)}" for _ in range(pvcount)]
+
+
+def writeCIDCWorkbook(filename, nodecount, propcount, pvcount, rng):
+    # Properties are in columns G:K under a header on row 9, rows above it are title text.  About 1 in 10 properties is listed
+    # a second time for another mapping, and the '-' and empty Node rows the converter drops are always there.
+    rows = [[f"CIDC gap analysis, synthetic line {r}"] + [None] * 10 for r in range(8)]
+    rows.append([f"Column {c}" for c in 'ABCDEF'] + CIDC_HEADER)
+    pvformats = [lambda pvs: "[" + ", ".join(f"'{pv}'" for pv in pvs) + "]",
+                 lambda pvs: ", ".join(pvs),
+                 lambda pvs: ", ".join(f'"{pv}"' for pv in pvs)]
+    for nodename in nodeNames(nodecount):
+        for p in range(propcount):
+            pvcell = rng.choice(pvformats)(pvList(rng, pvcount)) if p % 3 == 0 else '-'
+            row = [None] * 6 + [nodename, f"{nodename.lower()}_prop_{p}", rng.choice(DATATYPES), pvcell, f"Note {p}"]
+            rows.append(row)
+            if rng.random() < 0.1:
+                rows.append(list(row))
+    rows.append([None] * 6 + ['-', 'unmapped', 'string', '-', None])
+    rows.append([None] * 6 + [None, 'no node', 'string', '-', None])
+    with pd.ExcelWriter(filename) as writer:
+        pd.DataFrame(rows).to_excel(writer, sheet_name='Gap Analysis', index=False, header=False)
+    return len(rows)
+
+
+def writeIDCWorkbook(filename, nodecount, propcount, pvcount, cdefraction, rng):
+    # One tab per node with the first property as the key, a Schema tab that gets excluded, and a relationships tab where every node
+    # except the first points at an earlier one.  CDE ids come out of a pool smaller than the property count so CDEs are shared between nodes.
+    nodes = nodeNames(nodecount)
+    cdepool = max(1, int(nodecount * propcount * cdefraction / 2))
+    rowcount = 0
+    with pd.ExcelWriter(filename) as writer:
+        pd.DataFrame([{'Node': nodename, 'Description': f"Synthetic node {nodename}"} for nodename in nodes]).to_excel(writer, sheet_name='Schema', index=False)
+        for nodename in nodes:
+            rows = []
+            for p in range(propcount):
+                row = {'Property': f"{nodename.lower()}_prop_{p}", 'Description': f"Description of property {p}<br>on {nodename}",
+                       'Required/optional': rng.choice(['R', 'O']), 'Key': 'yes' if p == 0 else None, 'CDE': None, 'Permissible values': None,
+                       'Notes': f"Note {p}"}
+                if rng.random() < cdefraction:
+                    row['CDE'] = float(2000000 + rng.randrange(cdepool))
+                elif p % 3 == 1:
+                    row['Permissible values'] = "\n".join(pvList(rng, pvcount))
+                rows.append(row)
+            pd.DataFrame(rows).to_excel(writer, sheet_name=nodename, index=False)
+            rowcount = rowcount + len(rows)
+        edges = [{'Source node': nodes[n], 'Destination node': nodes[rng.randrange(n)], 'Cardinality': 'many_to_one'} for n in range(1, len(nodes))]
+        pd.DataFrame(edges, columns=['Source node', 'Destination node', 'Cardinality']).to_excel(writer, sheet_name=IDC_EDGESHEET, index=False)
+    return rowcount
+
+
+def writeConfigs(workdir, args):
+    # Writes both workbooks and a config for each converter.  Outputs go to per-run directories, see runConverter
+    rng = random.Random(args.seed)
+    cidcrows = writeCIDCWorkbook(f"{workdir}cidc.xlsx", args.nodes, args.props, args.pvs, rng)
+    idcrows = writeIDCWorkbook(f"{workdir}idc.xlsx", args.nodes, args.props, args.pvs, args.cde_fraction, rng)
+    configs = {
+        'cidc': {'excelfile': '../cidc.xlsx', 'worksheet': 'Gap Analysis', 'mdffile': 'cidc_model.yml', 'separate_files': True,
+                 'mdffiles': [{'PropDefinitions': 'cidc_properties.yml'}, {'Terms': 'cidc_terms.yml'}]},
+        'idc': {'excelfile': '../idc.xlsx', 'excludetabs': ['Schema'], 'edgesheet': IDC_EDGESHEET, 'handle': 'NCIISM', 'version': '0.0.1',
+                'mdffiles': [{'Model': 'idc_model.yml'}, {'PropDefinitions': 'idc_properties.yml'}, {'Terms': 'idc_terms.yml'}],
+                'tags': [{'node': nodeNames(args.nodes)[0], 'category': 'administrative'}],
+                'cde_rate': args.cde_rate, 'mdfschema': os.path.abspath(args.schema) if args.schema else f"{workdir}no-mdf-schema.yaml"}
+    }
+    for layout, config in configs.items():
+        with open(f"{workdir}{layout}.yml", 'w') as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+    return {'cidc': cidcrows, 'idc': idcrows}
+
+
+def runChild(args):
+    # Runs one converter in this process with caDSR stubbed out and writes the instrument report to args.child[2]
+    layout, configfile, statsfile = args.child
+    # bento_meta warns for every Term and ValueSet it creates
+    warnings.filterwarnings("ignore")
+    sys.path.insert(0, ROOT)
+    from crdclib import crdclib
+    import cdecache
+    import instrument
+    import validation
+
+    def stubFetch(session, cdeid, version=None, cadsrurl=None):
+        time.sleep(args.latency)
+        return {'cdename': f"Synthetic CDE {cdeid}", 'cdedef': f"Definition of synthetic CDE {cdeid}", 'cdever': '1.00'}
+
+    cdecache.fetchCDEInfo = stubFetch
+    crdclib.getCDEInfo = lambda cdeid, version=None: stubFetch(None, cdeid, version)
+
+    with open(configfile) as f:
+        configs = yaml.safe_load(f)
+    if layout == 'idc' and not args.schema:
+        # No schema given: don't try to download one, validation falls back to the reference checks
+        validation.VALIDATORS[configs['mdfschema']] = None
+
+    if layout == 'cidc':
+        import CIDC2MDF as converter
+    else:
+        import IDC2MDF as converter
+    runargs = argparse.Namespace(configfile=configfile, verbose=0, incremental=False, refresh_cdes=False, cache_only=False, revalidate=False, stream=args.stream, plan=False, from_cache=False, changelog=None, patch=None, stats=None, profile=None)
+    instrument.enable(script=converter.__name__, configfile=configfile)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        converter.main(runargs)
+    instrument.writeReport(statsfile)
+
+
+def runConverter(workdir, layout, run, args):
+    # One converter run in a fresh output directory.  The IDC CDE cache is shared between runs unless --cold
+    rundir = f"{workdir}{layout}_run{run}/"
+    shutil.rmtree(rundir, ignore_errors=True)
+    os.makedirs(f"{rundir}loadsheets/")
+    with open(f"{workdir}{layout}.yml") as f:
+        configs = yaml.safe_load(f)
+    configs['workingpath'] = rundir
+    if layout == 'idc':
+        configs['loadsheetpath'] = f"{rundir}loadsheets/"
+        configs['cdecache'] = f"{rundir}cdecache.sqlite" if args.cold else f"{workdir}cdecache.sqlite"
+    configfile = f"{rundir}config.yml"
+    with open(configfile, 'w') as f:
+        yaml.safe_dump(configs, f, sort_keys=False)
+
+    statsfile = f"{rundir}stats.json"
+    command = [sys.executable, os.path.abspath(__file__), '--child', layout, configfile, statsfile, '--latency', str(args.latency)]
+    if args.stream:
+        command.append('--stream')
+    if args.schema:
+        command.extend(['--schema', args.schema])
+    subprocess.run(command, check=True, cwd=rundir)
+    with open(statsfile) as f:
+        report = json.load(f)
+    report['output_bytes'] = sum(os.path.getsize(rundir+filename) for filename in os.listdir(rundir) if filename.endswith('.yml') and filename != 'config.yml')
+    return report
+
+
+def stageMedians(reports):
+    # {stage: median wall time} over a list of runs
+    walls = {}
+    for report in reports:
+        for stage in report['stages']:
+            walls.setdefault(stage['stage'], []).append(stage['wall_s'])
+    return {stage: statistics.median(values) for stage, values in walls.items()}
+
+
+def printResults(layout, reports, baseline=None):
+    medians = stageMedians(reports)
+    basemedians = stageMedians(baseline) if baseline else {}
+    print(f"\n{layout.upper()}  {json.dumps(reports[0]['counts'])}")
+    print(f"{'stage':16s} {'wall s':>9s} {'cpu s':>9s} {'peak MB':>9s}" + (f" {'baseline':>9s} {'ratio':>7s}" if baseline else ''))
+    for stage in reports[0]['stages']:
+        name = stage['stage']
+        cpu = statistics.median(s['cpu_s'] for report in reports for s in report['stages'] if s['stage'] == name)
+        peak = max(s['peak_rss_mb'] for report in reports for s in report['stages'] if s['stage'] == name)
+        line = f"{name:16s} {medians[name]:9.3f} {cpu:9.3f} {peak:9.1f}"
+        if name in basemedians:
+            line = line + f" {basemedians[name]:9.3f} {medians[name] / basemedians[name] if basemedians[name] > 0 else float('nan'):7.2f}"
+        print(line)
+    total = statistics.median(report['total_wall_s'] for report in reports)
+    line = f"{'total':16s} {total:9.3f} {statistics.median(report['total_cpu_s'] for report in reports):9.3f} {max(report['peak_rss_mb'] for report in reports):9.1f}"
+    if baseline:
+        basetotal = statistics.median(report['total_wall_s'] for report in baseline)
+        line = line + f" {basetotal:9.3f} {total / basetotal:7.2f}"
+    print(line)
+    print(f"MDF output {reports[0]['output_bytes']} bytes, {len(reports)} runs, median times")
+
+
+def main(args):
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='bench_converters_')
+    workdir = os.path.join(os.path.abspath(workdir), '')
+    os.makedirs(workdir, exist_ok=True)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    start = time.perf_counter()
+    rows = writeConfigs(workdir, args)
+    print(f"Synthetic workbooks in {workdir}: {args.nodes} nodes x {args.props} properties, {rows['cidc']} CIDC rows, {rows['idc']} IDC rows ({time.perf_counter()-start:.1f} s)")
+
+    results = {'params': vars(args), 'results': {}}
+    for layout in args.layouts:
+        reports = [runConverter(workdir, layout, run, args) for run in range(args.repeat)]
+        results['results'][layout] = reports
+        printResults(layout, reports, baseline['results'].get(layout) if baseline else None)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nodes', type=int, default=20, help="Number of nodes")
+    parser.add_argument('-p', '--props', type=int, default=50, help="Properties per node")
+    parser.add_argument('--pvs', type=int, default=10, help="Permissible values per enumerated property")
+    parser.add_argument('--cde-fraction', type=float, default=0.3, help="Fraction of IDC properties with a CDE")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds each stubbed caDSR lookup takes")
+    parser.add_argument('--cde-rate', type=float, default=1000, help="cde_rate config for the IDC run")
+    parser.add_argument('--cold', action='store_true', help="Start every IDC run with an empty CDE cache.  Otherwise only the first run is cold")
+    parser.add_argument('--schema', help="Local MDF schema to validate against.  Without one only the reference checks run")
+    parser.add_argument('--stream', action='store_true', help="Run the converters with --stream")
+    parser.add_argument('-l', '--layouts', nargs='+', choices=['cidc', 'idc'], default=['cidc', 'idc'], help="Which converters to run")
+    parser.add_argument('-r', '--repeat', type=int, default=1, help="Runs per converter, times reported are medians")
+    parser.add_argument('-s', '--seed', type=int, default=1, help="Random seed for the workbooks")
+    parser.add_argument('-w', '--workdir', help="Directory for the workbooks and outputs, kept afterwards.  Default is a temporary directory")
+    parser.add_argument('-k', '--keep', action='store_true', help="Keep the temporary directory")
+    parser.add_argument('-o', '--output', help="Write all the results to this JSON file")
+    parser.add_argument('-b', '--baseline', help="JSON file from an earlier --output to compare against")
+    parser.add_argument('--child', nargs=3, metavar=('LAYOUT', 'CONFIG', 'STATS'), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.child:
+        runChild(args)
+    else:
+        main(args)
@@ -0,0 +1,57 @@
+# Micro-benchmark of CIDC2MDF PV cleaning: per-string split/cleanEnums versus the batch normalizeEnums
+# Usage: python benchmarks/bench_enums.py -n 50000
+import argparse
+import os
+import random
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CIDC2MDF
+
+
+PV_SAMPLES = ["['Yes', 'No', 'Unknown']",
+              "['Male', 'Female', \"Unknown, not reported\"]",
+              "['American Indian or Alaska Native', 'Asian', 'Black or African American', 'Native Hawaiian or Other Pacific Islander', 'White', 'Not reported']",
+              "Stage I, Stage II, Stage III, Stage IV",
+              "Crohn's disease, Ulcerative colitis",
+              '-']
+
+
+def buildSeries(rows, distinct):
+    # A PV column with rows cells drawn from distinct different strings
+    random.seed(42)
+    pool = [f"{random.choice(PV_SAMPLES)}, Extra {i}" for i in range(distinct)] + PV_SAMPLES
+    return pd.Series([random.choice(pool) for i in range(rows)])
+
+
+def perString(pv_series):
+    # What addEnums used to do for every row
+    results = []
+    for pvstring in pv_series:
+        if pvstring not in ['-'] and pd.notnull(pvstring):
+            results.append(CIDC2MDF.cleanEnums(pvstring.split(',')))
+        else:
+            results.append(None)
+    return results
+
+
+def main(args):
+    pv_series = buildSeries(args.rows, args.distinct)
+    print(f"{args.rows} PV cells, {pv_series.nunique()} distinct")
+    for name, func in [('per-string cleanEnums', perString), ('batch normalizeEnums', CIDC2MDF.normalizeEnums)]:
+        best = min(timeit.repeat(lambda: func(pv_series), number=1, repeat=args.repeat))
+        print(f"{name:25s} {best*1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rows', type=int, default=50000, help="Number of PV cells")
+    parser.add_argument('-d', '--distinct', type=int, default=500, help="Number of distinct PV strings")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Timing repeats, best is reported")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,64 @@
+# Startup time of the command lines: --help, a config check, and importing the converter modules, each in a fresh interpreter.
+# Also lists which of the heavy libraries got imported, none of them should be for these commands.
+# Usage: python benchmarks/bench_startup.py -r 10 -c myconfig.yml
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'bento_meta', 'bento_mdf', 'crdclib', 'requests', 'jsonschema', 'openpyxl', 'IPython']
+IMPORT_CHECK = "import sys; import {modules}; print(','.join(m for m in {heavy} if m in sys.modules))"
+
+
+def timeCommand(command, repeat):
+    # Median wall time in ms of running command repeat times, and the last run's output
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO, capture_output=True, text=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), result.stdout
+
+
+def commands(args):
+    # (label, command) pairs to time
+    python = sys.executable
+    runs = [('python -c pass', [python, '-c', 'pass']),
+            ('CIDC2MDF.py --help', [python, 'CIDC2MDF.py', '--help']),
+            ('IDC2MDF.py --help', [python, 'IDC2MDF.py', '--help']),
+            ('batch2mdf.py --help', [python, 'batch2mdf.py', '--help']),
+            ('mdfconvert.py --help', [python, 'mdfconvert.py', '--help']),
+            ('mdfconvert.py idc --help', [python, 'mdfconvert.py', 'idc', '--help'])]
+    if args.configfiles:
+        runs.append(('mdfconvert.py check', [python, 'mdfconvert.py', 'check', '-c'] + [os.path.abspath(configfile) for configfile in args.configfiles]))
+    return runs
+
+
+def main(args):
+    print(f"{'command':30s} {'median ms':>10s}")
+    for label, command in commands(args):
+        median, output = timeCommand(command, args.repeat)
+        print(f"{label:30s} {median:10.1f}")
+    modules = 'CIDC2MDF, IDC2MDF, batch2mdf, mdfconvert'
+    median, output = timeCommand([sys.executable, '-c', IMPORT_CHECK.format(modules=modules, heavy=HEAVY_MODULES)], args.repeat)
+    print(f"{'import the converter modules':30s} {median:10.1f}")
+    loaded = output.strip()
+    print(f"Heavy modules loaded by the imports: {loaded if loaded else 'none'}")
+    if args.full:
+        # What the old eager imports cost, for comparison
+        median, output = timeCommand([sys.executable, '-c', 'import pandas, numpy, bento_meta.model, bento_mdf, crdclib.crdclib, requests, jsonschema, openpyxl'], args.repeat)
+        print(f"{'eager import of all of them':30s} {median:10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Runs of each command, the median is reported")
+    parser.add_argument('-c', '--configfiles', nargs='+', help="Config files to time 'mdfconvert.py check' on")
+    parser.add_argument('--full', action='store_true', help="Also time importing every heavy library up front, what --help used to cost")
+
+    args = parser.parse_args()
+
+    main(args)
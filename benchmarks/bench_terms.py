@@ -0,0 +1,117 @@
+# Term interning on a CIDC shaped model: the same PV lists (Yes/No/Unknown, sex, race, stage, ...) on properties of many nodes, plus
+# some lists only one property uses.  Builds the model with one Term per property PV (plain Model.add_terms) and with termpool.TermPool,
+# and reports Term objects, build time, the memory the model holds, and the size of the PropDefinitions and Terms YAML with and
+# without sharedenums.
+# Usage: python benchmarks/bench_terms.py -n 100 -p 300
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CIDC2MDF
+import mdfoutput
+
+import bento_mdf
+from bento_meta.model import Model
+
+PV_LISTS = [['Yes', 'No', 'Unknown'],
+            ['Yes', 'No'],
+            ['Male', 'Female', 'Unknown, not reported'],
+            ['American Indian or Alaska Native', 'Asian', 'Black or African American', 'Native Hawaiian or Other Pacific Islander', 'White', 'Not reported'],
+            ['Hispanic or Latino', 'Not Hispanic or Latino', 'Unknown'],
+            ['Stage 0', 'Stage I', 'Stage IA', 'Stage IB', 'Stage II', 'Stage IIA', 'Stage IIB', 'Stage III', 'Stage IIIA', 'Stage IIIB', 'Stage IV', 'Unknown'],
+            ['G1', 'G2', 'G3', 'G4', 'GX'],
+            ['0', '1', '2', '3', '4', '5'],
+            ['Grade 1', 'Grade 2', 'Grade 3', 'Grade 4', 'Grade 5'],
+            ['CTCAE', 'MedDRA']]
+
+
+def modelEntries(nodecount, propcount, uniquefraction, pvfraction, seed=42):
+    # {node: {property: [data type, enum list]}} like CIDC2MDF.propEntries.  A pvfraction of properties have PVs, a uniquefraction of
+    # those get a list of their own (sharing a few values with the common lists), the rest one of PV_LISTS
+    rng = random.Random(seed)
+    nodes = {}
+    for n in range(nodecount):
+        nodename = f"Node{n:04d}"
+        nodes[nodename] = {}
+        for p in range(propcount):
+            enums = None
+            if rng.random() < pvfraction:
+                if rng.random() < uniquefraction:
+                    enums = [f"{nodename} value {v}" for v in range(rng.randrange(2, 8))] + ['Unknown', 'Not reported']
+                else:
+                    enums = rng.choice(PV_LISTS)
+            nodes[nodename][f"{nodename.lower()} prop {p}"] = ['string', enums]
+    return nodes
+
+
+def plainEntries(datamodel, nodes):
+    # addPropEntries without a TermPool, what CIDC2MDF did before
+    for nodename, props in nodes.items():
+        for propname, (datatype, enumset) in props.items():
+            datamodel = CIDC2MDF.addPropEntry(datamodel, nodename, propname, datatype, enumset)
+    return datamodel
+
+
+def build(nodes, addentries):
+    return addentries(CIDC2MDF.addNodes(Model(handle='CIDC', version='0.01'), list(nodes.keys())), nodes)
+
+
+def measure(nodes, addentries):
+    # Builds the model twice, once timed and once under tracemalloc, which slows it down.  Returns (model, seconds, bytes held by the model, peak bytes)
+    start = time.perf_counter()
+    datamodel = build(nodes, addentries)
+    elapsed = time.perf_counter() - start
+    del datamodel
+    tracemalloc.start()
+    datamodel = build(nodes, addentries)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return datamodel, elapsed, current, peak
+
+
+def termObjects(datamodel):
+    # Distinct Term objects the value sets point at
+    return len({id(term) for prop in datamodel.props.values() if prop.value_set is not None for term in prop.value_set.terms.values()})
+
+
+def yamlSizes(datamodel, shared):
+    # Bytes of the PropDefinitions and Terms YAML
+    mdfdict = bento_mdf.MDFWriter(datamodel).mdf
+    if shared:
+        mdfoutput.shareEnums(mdfdict)
+    return [len(mdfoutput.dumpYAML({section: mdfdict[section]}, sort=True, indent=4).encode()) for section in ['PropDefinitions', 'Terms']]
+
+
+def main(args):
+    warnings.simplefilter('ignore')
+    nodes = modelEntries(args.nodes, args.props, args.unique, args.pvs)
+    enumprops = sum(1 for props in nodes.values() for datatype, enums in props.values() if enums is not None)
+    print(f"{args.nodes} nodes x {args.props} properties, {enumprops} with PVs")
+    print(f"{'build':22s} {'Term objects':>12s} {'seconds':>8s} {'model MB':>9s} {'peak MB':>8s}")
+    results = {}
+    for name, addentries in [('one Term per PV', plainEntries), ('TermPool', CIDC2MDF.addPropEntries)]:
+        datamodel, elapsed, current, peak = measure(nodes, addentries)
+        results[name] = datamodel
+        print(f"{name:22s} {termObjects(datamodel):12d} {elapsed:8.2f} {current/1e6:9.1f} {peak/1e6:8.1f}")
+    print(f"Same MDF from both: {bento_mdf.MDFWriter(results['one Term per PV']).mdf == bento_mdf.MDFWriter(results['TermPool']).mdf}")
+    print(f"{'output':22s} {'PropDefinitions':>15s} {'Terms':>8s}")
+    for name, shared in [('Enum lists', False), ('sharedenums', True)]:
+        propbytes, termbytes = yamlSizes(results['TermPool'], shared)
+        print(f"{name:22s} {propbytes:15d} {termbytes:8d}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nodes', type=int, default=100, help="Number of nodes")
+    parser.add_argument('-p', '--props', type=int, default=300, help="Properties per node")
+    parser.add_argument('--pvs', type=float, default=0.3, help="Fraction of properties with PVs")
+    parser.add_argument('-u', '--unique', type=float, default=0.1, help="Fraction of PV properties with a list of their own")
+
+    args = parser.parse_args()
+
+    main(args)
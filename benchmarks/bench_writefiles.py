@@ -0,0 +1,78 @@
+# Benchmark of MDF output on a synthetic model: the old json round-trip + crdclib.writeYAML path versus mdfoutput
+# Usage: python benchmarks/bench_writefiles.py -n 100 -p 100   (100 nodes x 100 properties = 10k properties)
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+from bento_meta.model import Model, Node, Property, Term
+from bento_mdf import MDFWriter
+from crdclib import crdclib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mdfoutput
+
+
+SECTIONS = [{'PropDefinitions': 'bench_properties.yml'}, {'Terms': 'bench_terms.yml'}, {'Model': 'bench_model.yml'}]
+
+
+def buildModel(nodecount, propcount):
+    # Every fourth property gets an enum, every fifth a caDSR term
+    datamodel = Model(handle='BENCH', version='0.0.1')
+    for n in range(nodecount):
+        nodename = f"node_{n}"
+        nodeobj = Node({'handle': nodename})
+        datamodel.add_node(nodeobj)
+        for p in range(propcount):
+            propname = f"{nodename}_prop_{p}"
+            propobj = Property({'handle': propname, '_parent_handle': nodename, 'is_required': 'No', 'value_domain': 'value_set' if p % 4 == 0 else 'string', 'desc': f"Description of {propname}"})
+            datamodel.add_prop(nodeobj, propobj)
+            if p % 4 == 0:
+                datamodel.add_terms(propobj, *[f"Value {v}" for v in range(5)])
+            if p % 5 == 0:
+                datamodel.annotate(propobj, Term({'handle': propname, 'value': f"CDE {p}", 'origin_name': 'caDSR', 'origin_id': str(p), 'origin_version': '1.0', 'origin_definition': f"Definition {p}"}))
+    return datamodel
+
+
+def oldWrite(datamodel, workingpath):
+    # The pre-mdfoutput writeFiles
+    mdfdict = json.loads(json.dumps(MDFWriter(datamodel).mdf))
+    for entry in SECTIONS:
+        for mdfsection, filename in entry.items():
+            if mdfsection != 'Model':
+                crdclib.writeYAML(workingpath+filename, {mdfsection: mdfdict.pop(mdfsection, None)})
+    crdclib.writeYAML(workingpath+'bench_model.yml', mdfdict)
+
+
+def newWrite(datamodel, workingpath, stream=False):
+    outputs = [(workingpath+filename, section) for filename, section in mdfoutput.splitSections(MDFWriter(datamodel).mdf, SECTIONS)]
+    mdfoutput.writeSections(outputs, stream=stream)
+
+
+def main(args):
+    # bento_meta warns for every Term and ValueSet it creates
+    warnings.filterwarnings("ignore")
+    datamodel = buildModel(args.nodes, args.props)
+    print(f"{len(datamodel.nodes)} nodes, {len(datamodel.props)} properties, {len(datamodel.terms)} terms, YAML emitter {mdfoutput.BaseDumper.__name__}")
+    with tempfile.TemporaryDirectory() as workingpath:
+        workingpath = workingpath+'/'
+        for name, func in [('json round-trip + writeYAML', lambda: oldWrite(datamodel, workingpath)),
+                           ('mdfoutput', lambda: newWrite(datamodel, workingpath)),
+                           ('mdfoutput, unchanged files', lambda: newWrite(datamodel, workingpath)),
+                           ('mdfoutput, streamed', lambda: newWrite(datamodel, workingpath, stream=True))]:
+            start = time.perf_counter()
+            func()
+            print(f"{name:30s} {time.perf_counter()-start:8.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nodes', type=int, default=100, help="Number of nodes")
+    parser.add_argument('-p', '--props', type=int, default=100, help="Properties per node")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,180 @@
+# Persistent on-disk cache for caDSR CDE lookups.  Keyed by (CDE id, version) and stored in SQLite so rebuilds don't hit caDSR for every row.
+import sqlite3
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+from lazy import lazyImport
+
+requests = lazyImport('requests')
+urllib3 = lazyImport('urllib3')
+
+# Entries older than this many days are refetched unless a different TTL is configured
+DEFAULT_TTL = 30
+CADSR_URL = "https://cadsrapi.cancer.gov/rad/NCIAPI/1.0/api/DataElement/"
+DEFAULT_WORKERS = 8
+# Maximum caDSR requests per second across all workers
+DEFAULT_RATE = 10
+
+
+def cleanCDEID(cdeid):
+    # For some reason, IDs out of Excel are formated like a float
+    return str(cdeid).split(".")[0].strip()
+
+
+def openCDECache(cachefile):
+    # Opens (and creates if needed) the SQLite cache file
+    conn = sqlite3.connect(cachefile)
+    conn.execute("CREATE TABLE IF NOT EXISTS cdecache (cdeid TEXT NOT NULL, cdeversion TEXT NOT NULL, cdeinfo TEXT NOT NULL, fetched REAL NOT NULL, PRIMARY KEY (cdeid, cdeversion))")
+    conn.commit()
+    return conn
+
+
+def readCDECache(conn, cdeid, version=None, ttl=DEFAULT_TTL):
+    # Returns the cached CDE info dictionary or None if missing or expired.  A ttl of None means entries never expire
+    cdeversion = '' if version is None else str(version)
+    row = conn.execute("SELECT cdeinfo, fetched FROM cdecache WHERE cdeid = ? AND cdeversion = ?", (cleanCDEID(cdeid), cdeversion)).fetchone()
+    if row is None:
+        return None
+    if ttl is not None and (time.time() - row[1]) > ttl * 86400:
+        return None
+    return json.loads(row[0])
+
+
+def writeCDECache(conn, cdeid, version, cdeinfo):
+    # Adds or replaces a cache entry
+    cdeversion = '' if version is None else str(version)
+    conn.execute("INSERT OR REPLACE INTO cdecache (cdeid, cdeversion, cdeinfo, fetched) VALUES (?, ?, ?, ?)", (cleanCDEID(cdeid), cdeversion, json.dumps(cdeinfo), time.time()))
+    conn.commit()
+
+
+def fetchedTimes(conn, cdelist):
+    # {cdeid: time it was fetched} for the CDE ids in cdelist that are in the cache
+    fetched = {}
+    for cdeid in cdelist:
+        row = conn.execute("SELECT fetched FROM cdecache WHERE cdeid = ? AND cdeversion = ''", (cleanCDEID(cdeid),)).fetchone()
+        if row is not None:
+            fetched[cleanCDEID(cdeid)] = row[0]
+    return fetched
+
+
+def pruneCDECache(conn, ttl=DEFAULT_TTL):
+    # Evicts expired entries, returns the number removed
+    if ttl is None:
+        return 0
+    cursor = conn.execute("DELETE FROM cdecache WHERE fetched < ?", (time.time() - ttl * 86400,))
+    conn.commit()
+    return cursor.rowcount
+
+
+def collectCDEs(nodedict):
+    # Returns the unique, cleaned CDE ids found in the CDE column of every node dataframe
+    cdelist = []
+    for working_df in nodedict.values():
+        if 'CDE' in working_df.columns:
+            for cdeid in working_df['CDE'].dropna():
+                cdeid = cleanCDEID(cdeid)
+                if cdeid not in cdelist:
+                    cdelist.append(cdeid)
+    return cdelist
+
+
+def cadsrSession(workers=DEFAULT_WORKERS):
+    # A pooled session with retries and backoff, sized so every worker gets a connection
+    retry = urllib3.util.Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry, pool_connections=workers, pool_maxsize=workers)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'accept': 'application/json'})
+    return session
+
+
+def fetchCDEInfo(session, cdeid, version=None, cadsrurl=CADSR_URL):
+    # Same return as crdclib.getCDEInfo but uses the supplied session
+    definition = None
+    cdename = None
+    cdeversion = None
+    url = cadsrurl+str(cdeid)
+    if version is not None:
+        url = url+"?version="+str(version)
+    try:
+        results = session.get(url=url, timeout=180)
+    except requests.exceptions.RequestException as e:
+        print(e)
+        return {'cdename': 'caDSR Name Error', 'cdedef': None, 'cdever': None}
+    if results.status_code == 200:
+        results = json.loads(results.content.decode())
+        if results['DataElement'] is not None:
+            if 'preferredName' in results['DataElement']:
+                cdename = results['DataElement']['preferredName']
+            else:
+                cdename = results['DataElement']['longName']
+            if 'preferredDefinition' in results['DataElement']:
+                definition = results['DataElement']['preferredDefinition']
+            else:
+                definition = results['DataElement']['definition']
+            cdeversion = results['DataElement']['version']
+    else:
+        cdename = 'caDSR Name Error'
+    return {'cdename': cdename, 'cdedef': definition, 'cdever': cdeversion}
+
+
+def rateLimiter(rate):
+    # Returns a function that blocks so calls are spaced at least 1/rate seconds apart across threads
+    lock = threading.Lock()
+    nextcall = [0.0]
+
+    def wait():
+        if not rate:
+            return
+        with lock:
+            now = time.monotonic()
+            delay = nextcall[0] - now
+            nextcall[0] = max(now, nextcall[0]) + 1.0 / rate
+        if delay > 0:
+            time.sleep(delay)
+    return wait
+
+
+def resolveCDEs(conn, cdelist, ttl=DEFAULT_TTL, cacheonly=False, refresh=False, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, cadsrurl=CADSR_URL, verbose=0):
+    # Resolves a list of CDE ids to a {cdeid: cdeinfo} lookup.  Cached entries are used as-is, the rest are fetched concurrently and written back to the cache.
+    lookup = {}
+    missing = []
+    for cdeid in cdelist:
+        cdeinfo = None if refresh else readCDECache(conn, cdeid, None, ttl)
+        if cdeinfo is not None:
+            lookup[cleanCDEID(cdeid)] = cdeinfo
+        else:
+            missing.append(cleanCDEID(cdeid))
+    instrument.count('cde_cache_hits', len(lookup))
+    instrument.count('cde_cache_misses', len(missing))
+    if verbose >= 1:
+        print(f"{len(lookup)} CDEs found in cache, {len(missing)} to fetch from caDSR")
+    if cacheonly:
+        if verbose >= 1 and len(missing) > 0:
+            print(f"Cache-only mode, skipping CDEs: {missing}")
+        return lookup
+    if len(missing) == 0:
+        return lookup
+
+    session = cadsrSession(workers)
+    wait = rateLimiter(rate)
+
+    def worker(cdeid):
+        wait()
+        if verbose >= 2:
+            print(f"Querying caDSR for CDE {cdeid}")
+        return cdeid, fetchCDEInfo(session, cdeid, None, cadsrurl)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for cdeid, cdeinfo in pool.map(worker, missing):
+            lookup[cdeid] = cdeinfo
+            instrument.count('cde_fetches')
+            # Don't cache failed lookups, they should be retried next time
+            if cdeinfo['cdename'] != 'caDSR Name Error':
+                writeCDECache(conn, cdeid, None, cdeinfo)
+    session.close()
+    return lookup
@@ -0,0 +1,80 @@
+# Config file checks that run before any converter does: the required keys are there, the input files exist and the named tabs are in
+# the workbook.  Only yaml and the standard library are used, so a check takes milliseconds.
+import os
+
+import yaml
+
+import loadsheets
+import workbook
+
+# Keys each converter can't run without.  The excelfile check is separate since --stream can use csvfile instead
+REQUIRED_KEYS = {'cidc': ['workingpath', 'worksheet', 'mdffile'],
+                 'idc': ['workingpath', 'excludetabs', 'edgesheet', 'handle', 'version', 'loadsheetpath']}
+
+
+def readConfig(configfile):
+    # Same as crdclib.readYAML without importing crdclib
+    with open(configfile) as f:
+        return yaml.safe_load(f)
+
+
+def converterName(configs):
+    # The converter to use for a config.  An explicit converter key wins, otherwise IDC configs are the ones with an edge sheet
+    if 'converter' in configs:
+        return configs['converter'].lower()
+    if 'edgesheet' in configs:
+        return 'idc'
+    if 'worksheet' in configs:
+        return 'cidc'
+    return None
+
+
+def checkConfig(configs, stream=False):
+    # Returns a list of problems with a loaded config, empty if it's good to run.  stream is whether --stream will be used
+    name = converterName(configs)
+    if name not in REQUIRED_KEYS:
+        return ["Can't tell which converter the config is for, add 'converter: cidc' or 'converter: idc'"]
+    problems = [f"Missing required key {key}" for key in REQUIRED_KEYS[name] if key not in configs]
+    if 'workingpath' not in configs:
+        return problems
+    workingpath = configs['workingpath']
+    if not os.path.isdir(workingpath):
+        problems.append(f"workingpath {workingpath} is not a directory")
+
+    if not configs.get('sharding'):
+        if name == 'idc' and 'mdffiles' not in configs:
+            problems.append("Missing required key mdffiles")
+        # CIDC2MDF.py only looks at separate_files when it isn't sharding
+        if name == 'cidc' and 'separate_files' not in configs:
+            problems.append("Missing required key separate_files")
+        if name == 'cidc' and configs.get('separate_files') and 'mdffiles' not in configs:
+            problems.append("separate_files is set but there's no mdffiles")
+    if configs.get('loadsheetformat', 'tsv') not in loadsheets.LOADSHEET_FORMATS:
+        problems.append(f"loadsheetformat must be one of {loadsheets.LOADSHEET_FORMATS}")
+    if name == 'idc' and configs.get('loadsheetpath') is not None and not os.path.isdir(configs['loadsheetpath']):
+        problems.append(f"loadsheetpath {configs['loadsheetpath']} is not a directory")
+
+    if stream and 'csvfile' in configs:
+        if not os.path.exists(workingpath+configs['csvfile']):
+            problems.append(f"csvfile {workingpath+configs['csvfile']} not found")
+        # IDC still reads the relationships from the workbook
+        if name == 'cidc':
+            return problems
+    if 'excelfile' not in configs:
+        problems.append("Missing required key excelfile")
+        return problems
+    excelfile = workingpath+configs['excelfile']
+    if not os.path.exists(excelfile):
+        problems.append(f"excelfile {excelfile} not found")
+        return problems
+    sheets = workbook.sheetNames(excelfile)
+    sheet = configs.get('worksheet') if name == 'cidc' else configs.get('edgesheet')
+    if sheet is not None and sheet not in sheets:
+        problems.append(f"Tab {sheet} is not in {configs['excelfile']}")
+    if name == 'idc':
+        # Node names are the tab names in lower case
+        nodes = [sheet.lower() for sheet in sheets]
+        for tag in configs.get('tags', []):
+            if tag['node'].lower() not in nodes:
+                problems.append(f"Tag node {tag['node']} has no tab in {configs['excelfile']}")
+    return problems
@@ -0,0 +1,72 @@
+# Support for incremental rebuilds.  A manifest stored next to the outputs records fingerprints of the config and of every
+# worksheet, plus what was built from them, so the next run only has to redo what changed.
+import hashlib
+import json
+import os
+
+# Bump this if the manifest layout or what gets stored in it changes, old manifests are then ignored
+MANIFEST_VERSION = 2
+
+
+def configFingerprint(configs):
+    # Hash of the parsed config, key order doesn't matter
+    return hashlib.sha256(json.dumps(configs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fileFingerprint(filename):
+    # Hash of a file on disk, None if it doesn't exist
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def manifestFile(configs, defaultname):
+    # The manifest lives in workingpath unless the config says otherwise
+    return configs['workingpath']+configs.get('manifest', defaultname)
+
+
+def readManifest(filename):
+    # Returns the stored manifest, or an empty one if missing or written by a different manifest version
+    empty = {'version': MANIFEST_VERSION, 'config': None, 'sheets': {}, 'fragments': {}, 'outputs': {}}
+    if not os.path.exists(filename):
+        return empty
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return empty
+    return manifest
+
+
+def writeManifest(filename, manifest):
+    manifest['version'] = MANIFEST_VERSION
+    with open(filename, 'w') as f:
+        json.dump(manifest, f)
+
+
+def changedSheets(manifest, fingerprints, confighash):
+    # Returns the sheet names that are new or whose content changed.  Everything has changed if the config did.
+    if manifest['config'] != confighash:
+        return list(fingerprints.keys())
+    return [sheet for sheet, fingerprint in fingerprints.items() if manifest['sheets'].get(sheet) != fingerprint]
+
+
+def outputsCurrent(manifest):
+    # True if every output recorded in the manifest is still on disk, unchanged
+    if len(manifest['outputs']) == 0:
+        return False
+    for filename, fingerprint in manifest['outputs'].items():
+        if fileFingerprint(filename) != fingerprint:
+            return False
+    return True
+
+
+def writeTextIfChanged(filename, content):
+    # Writes content unless the file already holds exactly that.  Returns (written, fingerprint)
+    content = content.encode()
+    fingerprint = hashlib.sha256(content).hexdigest()
+    if fileFingerprint(filename) == fingerprint:
+        return False, fingerprint
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return True, fingerprint
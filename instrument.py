@@ -0,0 +1,92 @@
+# Optional run instrumentation for the converters: per-stage wall and CPU time, counters and peak memory, written out as JSON so CI
+# can track them across model versions.  Everything here is a no-op until enable() is called.
+import cProfile
+import importlib.util
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+STATS = None
+
+
+def enable(**info):
+    # Starts collecting.  Anything passed in (script name, config file, ...) is copied into the report
+    global STATS
+    STATS = {'info': info, 'stages': [], 'counts': {}, 'start_wall': time.perf_counter(), 'start_cpu': time.process_time()}
+
+
+def enabled():
+    return STATS is not None
+
+
+def peakMemoryMB():
+    # Peak resident set size of this process so far.  Linux reports kilobytes, macOS bytes
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+
+@contextmanager
+def stage(name):
+    # Times the enclosed block as one stage of the run
+    if STATS is None:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        STATS['stages'].append({'stage': name,
+                                'wall_s': round(time.perf_counter() - wall, 6),
+                                'cpu_s': round(time.process_time() - cpu, 6),
+                                'peak_rss_mb': round(peakMemoryMB(), 1)})
+
+
+def count(name, amount=1):
+    # Adds to a named counter (rows, props, CDE calls, cache hits, ...)
+    if STATS is not None:
+        STATS['counts'][name] = STATS['counts'].get(name, 0) + amount
+
+
+def report():
+    # The collected numbers as a JSON ready dictionary
+    if STATS is None:
+        return None
+    return {'info': STATS['info'],
+            'total_wall_s': round(time.perf_counter() - STATS['start_wall'], 6),
+            'total_cpu_s': round(time.process_time() - STATS['start_cpu'], 6),
+            'peak_rss_mb': round(peakMemoryMB(), 1),
+            'stages': STATS['stages'],
+            'counts': STATS['counts']}
+
+
+def writeReport(filename):
+    # Writes the report as JSON, '-' writes it to stdout
+    if filename == '-':
+        print(json.dumps(report(), indent=2))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(report(), f, indent=2)
+
+
+def profiled(func, profilefile, *args):
+    # Runs func(*args) under a profiler.  An .html file gets a pyinstrument report if pyinstrument is installed, anything else a cProfile dump for pstats/snakeviz
+    if profilefile.endswith('.html') and importlib.util.find_spec('pyinstrument') is not None:
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func(*args)
+        finally:
+            profiler.stop()
+            with open(profilefile, 'w') as f:
+                f.write(profiler.output_html())
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(profilefile)
@@ -0,0 +1,28 @@
+# Deferred imports.  pandas, bento_meta, bento_mdf, crdclib, requests and openpyxl take most of a second to import between them, so the
+# modules bind them with lazyImport() and they're only loaded the first time something is used from them.  --help and config checks never do.
+import importlib
+import threading
+
+IMPORT_LOCK = threading.Lock()
+
+
+class LazyModule:
+    # Stands in for a module until the first attribute lookup, then imports it and hands everything on to the real module
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with IMPORT_LOCK:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazyImport(name):
+    return LazyModule(name)
@@ -0,0 +1,164 @@
+# Data load sheet (submission template) generation.  Same columns as crdclib.mdfBuildLoadSheets, but the key properties and edges are indexed
+# in one pass over the model instead of rescanning every edge and destination property for each node.  Sheets can be written as one TSV
+# per node (in parallel), one multi-sheet xlsx, one empty Parquet file per node (the column schema), or a zip of TSVs, and files whose content
+# hasn't changed are left alone.
+import hashlib
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import incremental
+from lazy import lazyImport
+
+pd = lazyImport('pandas')
+
+LOADSHEET_FORMATS = ['tsv', 'xlsx', 'parquet', 'zip']
+# Excel limit on sheet name length
+XLSX_SHEETNAME_MAX = 31
+# Fixed timestamp for zip members so the same sheets always give the same bytes
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def edgeIndex(datamodel):
+    # {node: [(src, dst) of every edge the node is in]}, in model edge order
+    edges = {nodename: [] for nodename in datamodel.nodes}
+    for (edgehandle, src, dst) in datamodel.edges:
+        edges[src].append((src, dst))
+        if dst != src:
+            edges[dst].append((src, dst))
+    return edges
+
+
+def modelIndex(datamodel):
+    # One pass over the model.  Returns ({node: [template columns]}, {node: [key properties]}, edgeIndex)
+    columns = {}
+    keys = {}
+    for nodename, nodeobj in datamodel.nodes.items():
+        columns[nodename] = []
+        keys[nodename] = []
+        for propname, propobj in nodeobj.props.items():
+            # Any property set to 'Template: No' is left off the load sheet
+            if 'Template' not in propobj.tags or propobj.tags['Template'].get_attr_dict()['value'] != 'No':
+                columns[nodename].append(propname)
+            if propobj.get_attr_dict().get('is_key') == 'True':
+                keys[nodename].append(propname)
+    return columns, keys, edgeIndex(datamodel)
+
+
+def sheetColumns(columns, keys, edges, reverse=False, typecolumn=False):
+    # {node: [load sheet columns]} from the modelIndex tables.  The linking node.property columns go on the edge's src node (dst if reverse),
+    # each one inserted at the front the way crdclib.mdfBuildLoadSheets does it
+    sheets = {}
+    for nodename, nodecolumns in columns.items():
+        sheetcolumns = list(nodecolumns)
+        for src, dst in edges.get(nodename, []):
+            if reverse and dst == nodename:
+                linknode = src
+            elif not reverse and src == nodename:
+                linknode = dst
+            else:
+                continue
+            for key in keys.get(linknode, []):
+                sheetcolumns.insert(0, f"{linknode}.{key}")
+        if typecolumn:
+            sheetcolumns.insert(0, 'type')
+        sheets[nodename] = sheetcolumns
+    return sheets
+
+
+def buildLoadSheets(datamodel, reverse=False, typecolumn=False):
+    # Drop in for crdclib.mdfBuildLoadSheets that returns {node: [columns]} instead of empty dataframes
+    return sheetColumns(*modelIndex(datamodel), reverse=reverse, typecolumn=typecolumn)
+
+
+def tsvText(columns):
+    # Same text as pd.DataFrame(columns=columns).to_csv(sep="\t", index=False)
+    return pd.DataFrame(columns=columns).to_csv(sep="\t", index=False)
+
+
+def zipFingerprint(data):
+    # Hash of the members of a zip (xlsx is a zip too), leaving out the document properties where the save time is kept
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for member in sorted(archive.namelist()):
+            if member != 'docProps/core.xml':
+                digest.update(member.encode() + b'\0' + archive.read(member) + b'\0')
+    return digest.hexdigest()
+
+
+def writeBytesIfChanged(filename, data, samecontent=None):
+    # Writes data unless the file already holds it.  samecontent(old, new) can decide two different byte strings hold the same thing,
+    # e.g. an xlsx saved at a different time.  Returns (written, fingerprint of the file on disk)
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            olddata = f.read()
+        if olddata == data or (samecontent is not None and samecontent(olddata, data)):
+            return False, hashlib.sha256(olddata).hexdigest()
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return True, hashlib.sha256(data).hexdigest()
+
+
+def xlsxBytes(sheets):
+    # One workbook, one sheet per node with the columns as the header row
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for nodename, columns in sheets.items():
+            pd.DataFrame(columns=columns).to_excel(writer, sheet_name=nodename[:XLSX_SHEETNAME_MAX], index=False)
+    return buffer.getvalue()
+
+
+def zipBytes(sheets, prefix):
+    # A zip with the same TSV files the tsv format writes
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for nodename, columns in sheets.items():
+            archive.writestr(zipfile.ZipInfo(f"{prefix}{nodename}.tsv", ZIP_DATE), tsvText(columns))
+    return buffer.getvalue()
+
+
+def parquetBytes(columns):
+    # An empty table with every column as a string, i.e. just the schema.  Needs pyarrow or fastparquet
+    buffer = io.BytesIO()
+    pd.DataFrame({column: pd.Series(dtype='string') for column in columns}).to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def loadSheetFiles(sheets, loadsheetpath, prefix, fileformat='tsv'):
+    # The file(s) a format writes.  Per node formats give {node: filename}, the bundles {None: filename}
+    if fileformat in ['xlsx', 'zip']:
+        return {None: f"{loadsheetpath}{prefix.rstrip('_')}s.{fileformat}"}
+    return {nodename: f"{loadsheetpath}{prefix}{nodename}.{fileformat}" for nodename in sheets}
+
+
+def writeLoadSheets(sheets, loadsheetpath, prefix, fileformat='tsv', workers=None, verbose=0):
+    # Writes {node: [columns]} in the requested format.  Unchanged files are not rewritten.  Returns {filename: fingerprint}
+    if fileformat not in LOADSHEET_FORMATS:
+        raise ValueError(f"Unknown load sheet format {fileformat}, must be one of {LOADSHEET_FORMATS}")
+    files = loadSheetFiles(sheets, loadsheetpath, prefix, fileformat)
+    fingerprints = {}
+    if fileformat == 'xlsx':
+        written, fingerprints[files[None]] = writeBytesIfChanged(files[None], xlsxBytes(sheets), lambda old, new: zipFingerprint(old) == zipFingerprint(new))
+        if verbose >= 1:
+            print(f"Writing load sheet workbook {files[None]}" if written else f"Unchanged load sheet workbook {files[None]}")
+        return fingerprints
+    if fileformat == 'zip':
+        written, fingerprints[files[None]] = writeBytesIfChanged(files[None], zipBytes(sheets, prefix))
+        if verbose >= 1:
+            print(f"Writing load sheet bundle {files[None]}" if written else f"Unchanged load sheet bundle {files[None]}")
+        return fingerprints
+
+    def worker(nodename):
+        if fileformat == 'parquet':
+            return nodename, writeBytesIfChanged(files[nodename], parquetBytes(sheets[nodename]))
+        return nodename, incremental.writeTextIfChanged(files[nodename], tsvText(sheets[nodename]))
+
+    if workers is None:
+        workers = min(len(sheets), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for nodename, (written, fingerprint) in pool.map(worker, sheets):
+            if verbose >= 1 and written:
+                print(f"Writing load sheet for {nodename}")
+            fingerprints[files[nodename]] = fingerprint
+    return fingerprints
@@ -0,0 +1,53 @@
+# One command line for all the converters:
+#   python mdfconvert.py cidc -c config.yml ...    same as CIDC2MDF.py
+#   python mdfconvert.py idc -c config.yml ...     same as IDC2MDF.py
+#   python mdfconvert.py batch -c a.yml b.yml ...  same as batch2mdf.py
+#   python mdfconvert.py check -c a.yml b.yml      checks config files without converting anything
+# The converters import pandas, bento_meta and the rest lazily, so nothing heavy is loaded until a conversion actually starts.
+import argparse
+import os
+import time
+
+import CIDC2MDF
+import IDC2MDF
+import batch2mdf
+import configcheck
+
+
+def check(args):
+    # Checks every config and prints what's wrong.  Returns the number of configs with problems
+    failed = 0
+    for configfile in args.configfiles:
+        start = time.perf_counter()
+        if not os.path.exists(configfile):
+            problems = ["Config file not found"]
+        else:
+            problems = configcheck.checkConfig(configcheck.readConfig(configfile), args.stream)
+        elapsed = (time.perf_counter() - start) * 1000
+        if len(problems) == 0:
+            print(f"{configfile}: OK ({elapsed:.1f} ms)")
+        else:
+            failed = failed + 1
+            print(f"{configfile}: {len(problems)} problem(s) ({elapsed:.1f} ms)")
+            for problem in problems:
+                print(f"  {problem}")
+    return failed
+
+
+def parser():
+    mainparser = argparse.ArgumentParser(description="Convert CIDC and IDC model workbooks to MDF")
+    subparsers = mainparser.add_subparsers(dest='command', required=True)
+    CIDC2MDF.addArguments(subparsers.add_parser('cidc', help="Convert a CIDC gap analysis workbook")).set_defaults(func=CIDC2MDF.run)
+    IDC2MDF.addArguments(subparsers.add_parser('idc', help="Convert an NCI Imaging submission model workbook")).set_defaults(func=IDC2MDF.run)
+    batch2mdf.addArguments(subparsers.add_parser('batch', help="Convert several models in one process")).set_defaults(func=batch2mdf.run)
+    checkparser = subparsers.add_parser('check', help="Check config files without converting anything")
+    checkparser.add_argument("-c", "--configfiles", required=True, nargs='+', help="Configuration files to check")
+    checkparser.add_argument('--stream', action='store_true', help="Check for a run with --stream, where csvfile can replace the workbook")
+    checkparser.set_defaults(func=check)
+    return mainparser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    status = args.func(args)
+    raise SystemExit(1 if status else 0)
@@ -0,0 +1,180 @@
+# MDF output stage shared by the converters.  The MDF dictionary is built once, split into the configured files without copying, and each
+# file is dumped with the libyaml C emitter when PyYAML was built with it.
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import yaml
+
+# Same output as yaml.safe_dump, just faster when libyaml is available
+BaseDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class EnumList(list):
+    # An Enum list that shareEnums has found on more than one property
+    pass
+
+
+class MDFDumper(BaseDumper):
+    # The MDF dict can share list/dict objects between entries, never write those as YAML anchors.  The exception is EnumList, which is
+    # written out once with an anchor and referred to by alias after that
+    def ignore_aliases(self, data):
+        return not isinstance(data, EnumList)
+
+
+MDFDumper.add_representer(EnumList, MDFDumper.represent_list)
+
+
+def dumpYAML(jsonobj, stream=None, sort=False, **kwargs):
+    # Same formatting as crdclib.writeYAML.  Returns the YAML text if no stream is given
+    return yaml.dump(jsonobj, stream, Dumper=MDFDumper, sort_keys=sort, **kwargs)
+
+
+def shareEnums(mdfdict):
+    # Makes every PropDefinitions Enum list with the same values one shared EnumList, so each distinct list of PVs is written once
+    # (&id001) and the other properties refer to it (*id001).  Any YAML loader, the MDF readers included, expands them again.  Anchors
+    # only reach within a file, so with sharding each shard has its own copy.  Returns the number of distinct Enum lists
+    enumlists = {}
+    for propspec in (mdfdict.get('PropDefinitions') or {}).values():
+        if isinstance(propspec, dict) and isinstance(propspec.get('Enum'), list):
+            key = tuple(propspec['Enum'])
+            if key not in enumlists:
+                enumlists[key] = EnumList(propspec['Enum'])
+            propspec['Enum'] = enumlists[key]
+    return len(enumlists)
+
+
+def splitSections(mdfdict, sectionfiles, restfile=None):
+    # Splits an MDF dict into [(filename, dict)].  sectionfiles is a list of {section: filename}, a 'Model' entry or restfile gets whatever
+    # sections are left.  Sections are moved, not copied, so mdfdict is emptied out along the way.
+    outputs = []
+    for entry in sectionfiles:
+        for mdfsection, filename in entry.items():
+            if mdfsection == 'Model':
+                restfile = filename
+            else:
+                outputs.append((filename, {mdfsection: mdfdict.pop(mdfsection, None)}))
+    if restfile is not None:
+        outputs.append((restfile, dict(mdfdict)))
+        mdfdict.clear()
+    return outputs
+
+
+def writeYAMLFile(filename, jsonobj, stream=False, **kwargs):
+    # Writes one YAML file and returns (written, fingerprint).  Normally the YAML is built in memory and the file is left alone if it
+    # already has that content.  With stream=True it is emitted straight to disk and always written.
+    if stream:
+        with open(filename, 'w') as f:
+            dumpYAML(jsonobj, f, **kwargs)
+        with open(filename, 'rb') as f:
+            return True, hashlib.sha256(f.read()).hexdigest()
+    content = dumpYAML(jsonobj, **kwargs).encode()
+    fingerprint = hashlib.sha256(content).hexdigest()
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == fingerprint:
+                return False, fingerprint
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return True, fingerprint
+
+
+def writeSections(outputs, workers=None, stream=False, verbose=0, **kwargs):
+    # Writes [(filename, dict)] in parallel.  Returns {filename: fingerprint}
+    if workers is None:
+        workers = min(len(outputs), os.cpu_count() or 1)
+    fingerprints = {}
+
+    def worker(output):
+        return output[0], writeYAMLFile(output[0], output[1], stream, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for filename, (written, fingerprint) in pool.map(worker, outputs):
+            if verbose >= 1:
+                print(f"Writing file {filename}" if written else f"Unchanged file {filename}")
+            fingerprints[filename] = fingerprint
+    return fingerprints
+
+
+def writeShard(output):
+    # Process pool worker, needs to be a top level function so it can be pickled
+    filename, jsonobj = output
+    return filename, writeYAMLFile(filename, jsonobj)
+
+
+def nodeTerms(datamodel):
+    # {nodename: [term handles]} for the Enum and Term entries of each node's properties, so each shard only carries the Terms it uses
+    nodeterms = {}
+    for nodename, nodeobj in datamodel.nodes.items():
+        nodeterms[nodename] = []
+        for propobj in nodeobj.props.values():
+            if propobj.value_set is not None:
+                nodeterms[nodename].extend(term.handle for term in propobj.value_set.terms.values())
+            if propobj.concept is not None:
+                nodeterms[nodename].extend(term.handle for term in propobj.concept.terms.values())
+    return nodeterms
+
+
+def shardMDF(mdfdict, nodeterms, shardsize=None):
+    # Splits an MDF dict into [(nodes, dict)].  The first shard holds everything that isn't node specific (Handle, Version, Relationships, ...).
+    # Each node goes in one shard with its PropDefinitions and Terms.  With a shardsize, nodes are grouped until a shard has at least that many properties.
+    nodes = mdfdict.pop('Nodes')
+    propdefs = mdfdict.pop('PropDefinitions')
+    terms = mdfdict.pop('Terms')
+    shards = [([], mdfdict)]
+    current = None
+    for nodename, nodespec in nodes.items():
+        if current is None:
+            current = ([], {'Nodes': {}, 'PropDefinitions': {}, 'Terms': {}})
+            shards.append(current)
+        current[0].append(nodename)
+        current[1]['Nodes'][nodename] = nodespec
+        for propname in nodespec.get('Props') or []:
+            current[1]['PropDefinitions'][propname] = propdefs[propname]
+        for termhandle in nodeterms.get(nodename, []):
+            current[1]['Terms'][termhandle] = terms[termhandle]
+        if shardsize is None or len(current[1]['PropDefinitions']) >= shardsize:
+            current = None
+    return shards
+
+
+def writeShardedMDF(mdfdict, nodeterms, shardpath, prefix, shardsize=None, workers=None, verbose=0):
+    # Writes the shards from shardMDF with a process pool, plus a manifest listing them in load order.  Shards left over from an
+    # earlier run are removed.  Returns {filename: fingerprint}, the manifest included.
+    os.makedirs(shardpath, exist_ok=True)
+    manifestfile = f"{shardpath}{prefix}_shards.yml"
+    manifest = {'Handle': mdfdict.get('Handle'), 'Version': mdfdict.get('Version'), 'Shards': []}
+    outputs = []
+    for index, (nodes, shard) in enumerate(shardMDF(mdfdict, nodeterms, shardsize)):
+        filename = f"{prefix}_model.yml" if index == 0 else f"{prefix}_shard_{index:04d}.yml"
+        manifest['Shards'].append({'File': filename, 'Nodes': nodes})
+        outputs.append((shardpath+filename, shard))
+
+    if os.path.exists(manifestfile):
+        for oldfile in shardFiles(manifestfile):
+            if oldfile not in [output[0] for output in outputs] and os.path.exists(oldfile):
+                os.remove(oldfile)
+
+    fingerprints = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for filename, (written, fingerprint) in pool.map(writeShard, outputs, chunksize=max(1, len(outputs) // (4 * (os.cpu_count() or 1)))):
+            if verbose >= 2:
+                print(f"Writing shard {filename}" if written else f"Unchanged shard {filename}")
+            fingerprints[filename] = fingerprint
+    written, fingerprints[manifestfile] = writeYAMLFile(manifestfile, manifest)
+    if verbose >= 1:
+        print(f"Wrote {len(outputs)} MDF shards, manifest {manifestfile}")
+    return fingerprints
+
+
+def shardFiles(manifestfile, nodes=None):
+    # The shard files listed in a shard manifest, in load order.  If nodes is given only the base shard and the shards holding those nodes
+    # are returned, e.g. MDFValidator(*shardFiles(manifestfile, ['subject'])).  Relationships to nodes that aren't loaded will still be there.
+    with open(manifestfile) as f:
+        manifest = yaml.safe_load(f)
+    shardpath = os.path.dirname(manifestfile)
+    filelist = []
+    for shard in manifest['Shards']:
+        if nodes is None or len(shard['Nodes']) == 0 or any(node in nodes for node in shard['Nodes']):
+            filelist.append(os.path.join(shardpath, shard['File']))
+    return filelist
@@ -0,0 +1,136 @@
+# Staging area for building a bento_meta Model.  Nodes, properties, CDE terms, enums, tags and edges are collected into small indexed records
+# first, keyed the same way the Model keys them, so lookups and duplicate checks are dictionary hits instead of the list(mdfmodel.props) scans
+# the crdclib.mdf* helpers do on every call.  materialize() then builds the Model in one pass.
+from bento_meta.model import Model, Node, Property, Tag, Edge
+
+import instrument
+import termpool
+
+
+class NodeRecord:
+    __slots__ = ('handle', 'tags')
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.tags = {}
+
+
+class PropRecord:
+    # terms is {(handle or value, origin_name, origin_id, origin_version): term dict}, the key Model.annotate uses.  enums is an ordered set
+    __slots__ = ('node', 'handle', 'isreq', 'valtype', 'desc', 'iskey', 'terms', 'enums', 'tags')
+
+    def __init__(self, node, handle, isreq, valtype, desc, iskey=None):
+        self.node = node
+        self.handle = handle
+        self.isreq = isreq
+        self.valtype = valtype
+        self.desc = desc
+        self.iskey = iskey
+        self.terms = {}
+        self.enums = {}
+        self.tags = {}
+
+
+class EdgeRecord:
+    __slots__ = ('handle', 'multiplicity', 'src', 'dst', 'desc', 'tags')
+
+    def __init__(self, handle, multiplicity, src, dst, desc):
+        self.handle = handle
+        self.multiplicity = multiplicity
+        self.src = src
+        self.dst = dst
+        self.desc = desc
+        self.tags = {}
+
+
+class ModelBuilder:
+    # Same rules as the crdclib.mdf* functions: properties, terms, enums and edges pointing at nodes or properties that don't exist are skipped.
+    # Duplicates are dropped, the first node/property/term seen wins.  Edges are keyed (handle, src, dst) and the last one wins, as in Model.
+    def __init__(self, handle, version):
+        self.handle = handle
+        self.version = version
+        self.nodes = {}
+        self.props = {}
+        self.edges = {}
+
+    def addNodes(self, nodelist):
+        for nodename in nodelist:
+            if nodename not in self.nodes:
+                self.nodes[nodename] = NodeRecord(nodename)
+
+    def addProp(self, node, propname, isreq, valtype, desc, iskey=None):
+        # Returns False if the node doesn't exist or the property was already added
+        if node not in self.nodes or (node, propname) in self.props:
+            return False
+        self.props[(node, propname)] = PropRecord(node, propname, isreq, valtype, desc, iskey)
+        return True
+
+    def addProperties(self, node_prop_dict):
+        # Takes the same {node: [{prop, isreq, val, desc, iskey}]} dictionary as crdclib.mdfAddProperty
+        for node, properties in node_prop_dict.items():
+            for prop_info in properties:
+                self.addProp(node, prop_info['prop'], prop_info['isreq'], prop_info['val'], prop_info['desc'], prop_info.get('iskey'))
+
+    def annotate(self, nodename, propname, termdict):
+        # Same termdict as crdclib.mdfAnnotateTerms
+        record = self.props.get((nodename, propname))
+        if record is not None:
+            termkey = (termdict.get('handle') or termdict.get('value'), termdict.get('origin_name'), termdict.get('origin_id'), termdict.get('origin_version'))
+            record.terms.setdefault(termkey, termdict)
+
+    def addEnums(self, nodename, propname, enumlist):
+        # Makes the property a value_set, like crdclib.mdfAddEnums
+        record = self.props.get((nodename, propname))
+        if record is not None:
+            record.valtype = 'value_set'
+            for enum in enumlist:
+                record.enums[enum] = None
+
+    def addTag(self, objecttype, objectkey, tagdict):
+        # objecttype is node, property or edge, objectkey is what the Model keys it by.  Returns False if there's nothing to tag
+        tables = {'node': self.nodes, 'property': self.props, 'edge': self.edges}
+        record = tables[objecttype].get(objectkey)
+        if record is None:
+            return False
+        record.tags[tagdict['key']] = tagdict['value']
+        return True
+
+    def addEdge(self, handle, multiplicity, src, dst, desc):
+        if src in self.nodes and dst in self.nodes:
+            self.edges[(handle, src, dst)] = EdgeRecord(handle, multiplicity, src, dst, desc)
+
+    def addEdges(self, edgelist):
+        # Takes the same [{handle, multiplicity, src, dst, desc}] list as crdclib.mdfAddEdges
+        for edge in edgelist:
+            self.addEdge(edge['handle'], edge['multiplicity'], edge['src'], edge['dst'], edge['desc'])
+
+    def materialize(self):
+        # Builds the bento_meta Model in one pass.  Enum values and CDE terms shared between properties share one Term (termpool.py)
+        datamodel = Model(handle=self.handle, version=self.version)
+        pool = termpool.TermPool()
+        for record in self.nodes.values():
+            nodeobj = datamodel.add_node(Node({'handle': record.handle}))
+            addTags(nodeobj, record.tags)
+        for record in self.props.values():
+            propdict = {'handle': record.handle, '_parent_handle': record.node, 'is_required': record.isreq, 'value_domain': record.valtype, 'desc': record.desc}
+            if record.iskey is not None:
+                propdict['is_key'] = record.iskey
+            propobj = datamodel.add_prop(datamodel.nodes[record.node], Property(propdict))
+            addTags(propobj, record.tags)
+            for termdict in record.terms.values():
+                datamodel.annotate(propobj, pool.term(termdict))
+            if len(record.enums) > 0:
+                pool.addTerms(datamodel, propobj, record.enums)
+        for record in self.edges.values():
+            edgeobj = datamodel.add_edge(Edge({'handle': record.handle, 'multiplicity': record.multiplicity, 'src': datamodel.nodes[record.src],
+                                               'dst': datamodel.nodes[record.dst], 'desc': record.desc}))
+            addTags(edgeobj, record.tags)
+        instrument.count('term_objects', len(pool))
+        instrument.count('term_uses', pool.uses)
+        return datamodel
+
+
+def addTags(entity, tags):
+    for key, value in tags.items():
+        tagobj = Tag({'key': key, 'value': value})
+        entity.tags[tagobj.key] = tagobj
@@ -0,0 +1,149 @@
+# Structural diff between two MDF models, e.g. the model just built and the MDF files a previous run left on disk.  Every Nodes,
+# Relationships, PropDefinitions and Terms entry is hashed once and the two models are compared by key, so the diff is linear in the size of
+# the models.  The result can be written as a short changelog, or as a patch MDF holding only the entries that were added or changed.
+import hashlib
+import json
+import os
+
+import yaml
+
+import mdfoutput
+
+# Sections whose entries are compared one by one.  Anything else (Handle, Version, ...) is compared as a whole
+ENTRY_SECTIONS = ['Nodes', 'Relationships', 'PropDefinitions', 'Terms']
+# Same result as yaml.safe_load, faster when PyYAML was built with libyaml
+MDFLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def readMDF(filelist):
+    # Loads and merges MDF files the way the MDF readers do, later files adding to or overriding the sections of earlier ones.
+    # Files that don't exist are skipped, so a first run compares against an empty model
+    mdfdict = {}
+    for filename in filelist:
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            content = yaml.load(f, Loader=MDFLoader)
+        for section, value in (content or {}).items():
+            if isinstance(value, dict) and isinstance(mdfdict.get(section), dict):
+                mdfdict[section].update(value)
+            else:
+                mdfdict[section] = value
+    return mdfdict
+
+
+def entryHash(entry):
+    # Content hash of one entry.  Key order doesn't matter, list order does
+    return hashlib.sha1(json.dumps(entry, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def sectionIndex(section):
+    # {key: hash} for every entry in a section
+    return {key: entryHash(entry) for key, entry in (section or {}).items()}
+
+
+def fieldChanges(old, new):
+    # What changed inside one entry: {field: {'added': [...], 'removed': [...]}} for lists (Props, Enum, Ends, ...),
+    # {field: {'old': x, 'new': y}} for anything else
+    changes = {}
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return {'': {'old': old, 'new': new}}
+    for field in list(old) + [field for field in new if field not in old]:
+        oldvalue = old.get(field)
+        newvalue = new.get(field)
+        if oldvalue == newvalue:
+            continue
+        if isinstance(oldvalue, list) and isinstance(newvalue, list):
+            oldindex = {entryHash(item): item for item in oldvalue}
+            newindex = {entryHash(item): item for item in newvalue}
+            changes[field] = {'added': [item for key, item in newindex.items() if key not in oldindex],
+                              'removed': [item for key, item in oldindex.items() if key not in newindex]}
+            if len(changes[field]['added']) == 0 and len(changes[field]['removed']) == 0:
+                changes[field] = {'reordered': True}
+        else:
+            changes[field] = {'old': oldvalue, 'new': newvalue}
+    return changes
+
+
+def diffMDF(oldmdf, newmdf):
+    # Compares two MDF dictionaries.  Returns {section: {'added': [keys], 'removed': [keys], 'changed': {key: fieldChanges}}} for the entry
+    # sections and {section: {'old': x, 'new': y}} for any other section that differs.  Sections with no differences are left out
+    diff = {}
+    for section in ENTRY_SECTIONS:
+        oldsection = oldmdf.get(section) or {}
+        newsection = newmdf.get(section) or {}
+        oldindex = sectionIndex(oldsection)
+        newindex = sectionIndex(newsection)
+        added = [key for key in newindex if key not in oldindex]
+        removed = [key for key in oldindex if key not in newindex]
+        changed = {key: fieldChanges(oldsection[key], newsection[key]) for key, digest in newindex.items() if key in oldindex and oldindex[key] != digest}
+        if len(added) > 0 or len(removed) > 0 or len(changed) > 0:
+            diff[section] = {'added': added, 'removed': removed, 'changed': changed}
+    for section in list(oldmdf) + [section for section in newmdf if section not in oldmdf]:
+        if section not in ENTRY_SECTIONS and oldmdf.get(section) != newmdf.get(section):
+            diff[section] = {'old': oldmdf.get(section), 'new': newmdf.get(section)}
+    return diff
+
+
+def diffCounts(diff):
+    # {section: (added, removed, changed)} for the entry sections
+    return {section: (len(diff[section]['added']), len(diff[section]['removed']), len(diff[section]['changed'])) for section in ENTRY_SECTIONS if section in diff}
+
+
+def shortValue(value, width=60):
+    text = json.dumps(value, default=str) if not isinstance(value, str) else value
+    return text if len(text) <= width else text[:width-3]+'...'
+
+
+def changelog(diff, title=None):
+    # The diff as a markdown changelog, one line per added/removed entry and per changed field
+    lines = [f"# {title}" if title is not None else "# Model changes"]
+    if len(diff) == 0:
+        lines.append("No changes")
+        return '\n'.join(lines)+'\n'
+    for section, change in diff.items():
+        if section not in ENTRY_SECTIONS:
+            lines.append(f"- {section}: {shortValue(change['old'])} -> {shortValue(change['new'])}")
+    for section, (added, removed, changed) in diffCounts(diff).items():
+        lines.append(f"## {section}: {added} added, {removed} removed, {changed} changed")
+        lines.extend(f"+ {key}" for key in diff[section]['added'])
+        lines.extend(f"- {key}" for key in diff[section]['removed'])
+        for key, fields in diff[section]['changed'].items():
+            for field, fieldchange in fields.items():
+                if 'reordered' in fieldchange:
+                    lines.append(f"~ {key} {field}: reordered")
+                elif 'added' in fieldchange:
+                    parts = [f"+{shortValue(item, 40)}" for item in fieldchange['added']] + [f"-{shortValue(item, 40)}" for item in fieldchange['removed']]
+                    lines.append(f"~ {key} {field}: {' '.join(parts)}")
+                else:
+                    lines.append(f"~ {key} {field}: {shortValue(fieldchange['old'])} -> {shortValue(fieldchange['new'])}")
+    return '\n'.join(lines)+'\n'
+
+
+def patchMDF(diff, newmdf):
+    # An MDF holding only what was added or changed, which loaded after the old files gives the new model.  MDF can't say an entry
+    # was removed, so removals are only in the changelog
+    patch = {section: newmdf[section] for section in ['Handle', 'Version'] if section in newmdf}
+    for section in ENTRY_SECTIONS:
+        if section in diff:
+            keys = diff[section]['added'] + list(diff[section]['changed'])
+            if len(keys) > 0:
+                patch[section] = {key: newmdf[section][key] for key in keys}
+    return patch
+
+
+def writeDiff(oldfiles, newmdf, changelogfile=None, patchfile=None, title=None, verbose=0):
+    # Diffs newmdf against the MDF files on disk and writes the changelog ('-' for stdout) and patch MDF if asked.  Has to run before the
+    # new files are written, since they replace the old ones.  Returns the diff
+    diff = diffMDF(readMDF(oldfiles), newmdf)
+    if verbose >= 1:
+        for section, (added, removed, changed) in diffCounts(diff).items():
+            print(f"{section}: {added} added, {removed} removed, {changed} changed")
+    if changelogfile == '-':
+        print(changelog(diff, title), end='')
+    elif changelogfile is not None:
+        with open(changelogfile, 'w') as f:
+            f.write(changelog(diff, title))
+    if patchfile is not None:
+        mdfoutput.writeYAMLFile(patchfile, patchMDF(diff, newmdf), sort=True, indent=4)
+    return diff
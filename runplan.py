@@ -0,0 +1,56 @@
+# --plan support for the converters: what a run would do, worked out from the config and the workbook rows alone.  Nothing is built,
+# caDSR isn't contacted and no file (the CDE cache included) is created or changed.
+import os
+import sqlite3
+import time
+
+
+def cachedCDEs(cachefile, cdelist, ttl=None):
+    # How many of the cleaned CDE ids in cdelist have a current entry in the cache.  The cache is opened read only, a missing one counts as empty
+    if not os.path.exists(cachefile) or len(cdelist) == 0:
+        return 0
+    conn = sqlite3.connect(f"file:{cachefile}?mode=ro", uri=True)
+    try:
+        oldest = 0 if ttl is None else time.time() - ttl * 86400
+        cached = set()
+        for cdeid, fetched in conn.execute("SELECT cdeid, fetched FROM cdecache WHERE cdeversion = ''"):
+            if fetched >= oldest:
+                cached.add(cdeid)
+    except sqlite3.OperationalError:
+        # File exists but has no cache table yet
+        return 0
+    finally:
+        conn.close()
+    return len([cdeid for cdeid in cdelist if cdeid in cached])
+
+
+def shardFileList(shardpath, prefix, nodeprops, sharding):
+    # The files mdfoutput.writeShardedMDF would write for {node: property handles}, same grouping as mdfoutput.shardMDF.  A property
+    # on several nodes of a shard is one PropDefinitions entry, so it only counts once towards the shard size
+    shardsize = None if sharding == 'node' else int(sharding)
+    filelist = [f"{shardpath}{prefix}_shards.yml", f"{shardpath}{prefix}_model.yml"]
+    current = None
+    index = 0
+    for nodename, props in nodeprops.items():
+        if current is None:
+            index = index + 1
+            current = set()
+            filelist.append(f"{shardpath}{prefix}_shard_{index:04d}.yml")
+        current.update(props)
+        if shardsize is None or len(current) >= shardsize:
+            current = None
+    return filelist
+
+
+def printPlan(title, counts, files, cdes=None):
+    # counts is {label: number}, files the output file names, cdes {'total', 'cached', 'fetch', 'rate'} if the converter resolves CDEs
+    print(f"Plan for {title}.  Nothing has been built or written")
+    for label, number in counts.items():
+        print(f"  {label:24s} {number}")
+    if cdes is not None:
+        estimate = cdes['fetch'] / cdes['rate'] if cdes['rate'] else 0
+        print(f"CDEs: {cdes['total']} distinct, {cdes['cached']} cached, {cdes['fetch']} caDSR requests (about {estimate:.0f} s at {cdes['rate']} requests/s)")
+    newfiles = [filename for filename in files if not os.path.exists(filename)]
+    print(f"Files that would be written: {len(files)} ({len(newfiles)} new, the rest only if their content changes)")
+    for filename in files:
+        print(f"  {filename}{' (new)' if filename in newfiles else ''}")
@@ -0,0 +1,124 @@
+# Columnar cache of the cleaned model tables (nodes, properties, terms, enums, tags, edges) that sit between the workbook and the bento_meta
+# Model.  A run with tablecache set in its config saves them, a run with --from-cache rebuilds the Model from them without opening the workbook
+# or calling caDSR.  Tables are uncompressed Arrow/Feather files, which are read memory mapped without copying, or Parquet, one file per
+# table plus a small JSON file of run details.  Both formats need pyarrow.
+import json
+import os
+import time
+
+from lazy import lazyImport
+
+pa = lazyImport('pyarrow')
+feather = lazyImport('pyarrow.feather')
+parquet = lazyImport('pyarrow.parquet')
+
+TABLE_FORMATS = ['feather', 'parquet']
+META_FILE = 'tables.json'
+# Term fields kept from the term dictionaries passed to ModelBuilder.annotate
+TERM_FIELDS = ['handle', 'value', 'origin_name', 'origin_id', 'origin_version', 'origin_definition', 'nanoid']
+
+
+def tableFile(cachepath, name, fileformat):
+    return os.path.join(cachepath, f"{name}.{fileformat}")
+
+
+def writeTables(tables, cachepath, fileformat='feather', **meta):
+    # Writes {name: {column: [values]}}, one file per table.  Anything in meta (handle, version, source file, ...) goes in the JSON file
+    if fileformat not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table cache format {fileformat}, must be one of {TABLE_FORMATS}")
+    os.makedirs(cachepath, exist_ok=True)
+    counts = {}
+    for name, columns in tables.items():
+        table = pa.table(columns)
+        if fileformat == 'feather':
+            # Compressed Feather has to be decompressed into memory, uncompressed can be mapped as is
+            feather.write_feather(table, tableFile(cachepath, name, fileformat), compression='uncompressed')
+        else:
+            parquet.write_table(table, tableFile(cachepath, name, fileformat))
+        counts[name] = table.num_rows
+    meta.update({'format': fileformat, 'tables': counts, 'written': time.time()})
+    with open(os.path.join(cachepath, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def readTables(cachepath):
+    # Returns ({name: pyarrow.Table}, meta).  Feather tables are memory mapped, nothing is copied until rows() reads them.  Raises
+    # FileNotFoundError if nothing was cached at cachepath
+    with open(os.path.join(cachepath, META_FILE)) as f:
+        meta = json.load(f)
+    tables = {}
+    for name in meta['tables']:
+        filename = tableFile(cachepath, name, meta['format'])
+        if meta['format'] == 'feather':
+            tables[name] = feather.read_table(filename, memory_map=True)
+        else:
+            tables[name] = parquet.read_table(filename, memory_map=True)
+    return tables, meta
+
+
+def rows(table):
+    # The rows of a readTables table as dictionaries, nulls as None.  Converted a record batch at a time, so only one batch of Python
+    # objects exists at once
+    for batch in table.to_batches():
+        yield from batch.to_pylist()
+
+
+def builderTables(builder):
+    # The contents of a modelbuilder.ModelBuilder as tables.  Tag values are JSON so booleans and numbers from the config survive
+    tables = {'nodes': {'node': []},
+              'props': {'node': [], 'prop': [], 'isreq': [], 'valtype': [], 'desc': [], 'iskey': []},
+              'terms': {column: [] for column in ['node', 'prop'] + TERM_FIELDS},
+              'enums': {'node': [], 'prop': [], 'value': []},
+              'edges': {'handle': [], 'multiplicity': [], 'src': [], 'dst': [], 'desc': []},
+              'tags': {'objecttype': [], 'objectkey': [], 'key': [], 'value': []}}
+
+    def addRow(name, **values):
+        for column, value in values.items():
+            tables[name][column].append(value)
+
+    def addTags(objecttype, objectkey, tags):
+        for key, value in tags.items():
+            addRow('tags', objecttype=objecttype, objectkey=json.dumps(objectkey), key=key, value=json.dumps(value))
+
+    for record in builder.nodes.values():
+        addRow('nodes', node=record.handle)
+        addTags('node', record.handle, record.tags)
+    for record in builder.props.values():
+        addRow('props', node=record.node, prop=record.handle, isreq=record.isreq, valtype=record.valtype, desc=record.desc, iskey=record.iskey)
+        for termdict in record.terms.values():
+            addRow('terms', node=record.node, prop=record.handle, **{field: termdict.get(field) for field in TERM_FIELDS})
+        for enum in record.enums:
+            addRow('enums', node=record.node, prop=record.handle, value=enum)
+        addTags('property', [record.node, record.handle], record.tags)
+    for record in builder.edges.values():
+        addRow('edges', handle=record.handle, multiplicity=record.multiplicity, src=record.src, dst=record.dst, desc=record.desc)
+        addTags('edge', [record.handle, record.src, record.dst], record.tags)
+    return tables
+
+
+def mergeTables(tablelist):
+    # Concatenates builderTables outputs, e.g. those of the per-node builders of an incremental build, table by table
+    merged = {}
+    for tables in tablelist:
+        for name, columns in tables.items():
+            mergedcolumns = merged.setdefault(name, {column: [] for column in columns})
+            for column, values in columns.items():
+                mergedcolumns[column].extend(values)
+    return merged
+
+
+def loadBuilder(builder, tables):
+    # Fills an empty modelbuilder.ModelBuilder from the readTables copy of builderTables output, giving the same Model as the builder the tables came from
+    builder.addNodes([row['node'] for row in rows(tables['nodes'])])
+    for row in rows(tables['props']):
+        builder.addProp(row['node'], row['prop'], row['isreq'], row['valtype'], row['desc'], row['iskey'])
+    for row in rows(tables['terms']):
+        builder.annotate(row['node'], row['prop'], {field: row[field] for field in TERM_FIELDS})
+    for row in rows(tables['enums']):
+        builder.addEnums(row['node'], row['prop'], [row['value']])
+    for row in rows(tables['edges']):
+        builder.addEdge(row['handle'], row['multiplicity'], row['src'], row['dst'], row['desc'])
+    for row in rows(tables['tags']):
+        objectkey = json.loads(row['objectkey'])
+        builder.addTag(row['objecttype'], tuple(objectkey) if isinstance(objectkey, list) else objectkey, {'key': row['key'], 'value': json.loads(row['value'])})
+    return builder
@@ -0,0 +1,31 @@
+# Interning for the Terms of a model.  bento_meta's Model.add_terms makes a new Term for every string it's given, so a PV like 'Yes' that
+# 50 properties use becomes 50 Term objects, and only the last one is kept in Model.terms.  A TermPool makes one Term per distinct PV (or
+# CDE term dictionary), and every property's value set points at that same object.  The Model and the MDF written from it don't change.
+from lazy import lazyImport
+
+bentomodel = lazyImport('bento_meta.model')
+
+
+class TermPool:
+    def __init__(self):
+        # {PV string or sorted term dictionary items: Term}
+        self.terms = {}
+        # Number of times a Term was asked for, i.e. the Term objects there would be without the pool
+        self.uses = 0
+
+    def term(self, value):
+        # The Term for a PV string, with the value as its handle the way add_terms does it, or for a term dictionary as passed to Model.annotate
+        key = tuple(sorted(value.items())) if isinstance(value, dict) else value
+        self.uses = self.uses + 1
+        termobj = self.terms.get(key)
+        if termobj is None:
+            termobj = bentomodel.Term(value if isinstance(value, dict) else {'handle': value, 'value': value})
+            self.terms[key] = termobj
+        return termobj
+
+    def addTerms(self, datamodel, propobj, values):
+        # Model.add_terms with pooled Terms
+        datamodel.add_terms(propobj, *[self.term(value) for value in values])
+
+    def __len__(self):
+        return len(self.terms)
@@ -0,0 +1,118 @@
+# CDE cache behaviour against a local stub of the caDSR DataElement API: fetches are cached, expired entries and --refresh-cdes refetch,
+# --cache-only never goes to caDSR, and failed lookups aren't cached.
+# Usage: python -m pytest tests
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cdecache
+import IDC2MDF
+
+# CDE ids the stub answers with a 404
+FAILING = {'9999999'}
+
+
+class CaDSRStub(BaseHTTPRequestHandler):
+    def do_GET(self):
+        cdeid = self.path.rstrip('/').split('/')[-1].split('?')[0]
+        self.server.requests.append(cdeid)
+        if cdeid in FAILING:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({'DataElement': {'preferredName': f"CDE {cdeid}", 'preferredDefinition': f"Definition of {cdeid}", 'version': '1.00'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def cadsr():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CaDSRStub)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def configs(tmp_path, cadsr):
+    return {'workingpath': str(tmp_path)+'/', 'cdecache': str(tmp_path / 'cdecache.sqlite'), 'cdecache_ttl': 1, 'cde_rate': 0,
+            'cadsrurl': f"http://127.0.0.1:{cadsr.server_address[1]}/DataElement/"}
+
+
+def resolve(configs, cdelist, refresh=False, cacheonly=False):
+    args = argparse.Namespace(verbose=0, refresh_cdes=refresh, cache_only=cacheonly)
+    return IDC2MDF.resolveNodeCDEs(configs, cdelist, args)
+
+
+def cachedIDs(configs):
+    conn = sqlite3.connect(configs['cdecache'])
+    try:
+        return sorted(row[0] for row in conn.execute("SELECT cdeid FROM cdecache"))
+    finally:
+        conn.close()
+
+
+def test_fetches_are_cached(configs, cadsr):
+    lookup = resolve(configs, ['2192199.0', '2006861'])
+    assert lookup['2192199'] == {'cdename': 'CDE 2192199', 'cdedef': 'Definition of 2192199', 'cdever': '1.00'}
+    assert sorted(cadsr.requests) == ['2006861', '2192199']
+    assert cachedIDs(configs) == ['2006861', '2192199']
+
+    # Second run comes entirely from the cache
+    assert resolve(configs, ['2192199', '2006861']) == lookup
+    assert len(cadsr.requests) == 2
+
+
+def test_expired_entries_are_refetched(configs, cadsr):
+    resolve(configs, ['2192199', '2006861'])
+    conn = cdecache.openCDECache(configs['cdecache'])
+    conn.execute("UPDATE cdecache SET fetched = ? WHERE cdeid = '2192199'", (time.time() - 2 * 86400,))
+    conn.commit()
+    conn.close()
+
+    resolve(configs, ['2192199', '2006861'])
+    assert sorted(cadsr.requests) == ['2006861', '2192199', '2192199']
+    conn = cdecache.openCDECache(configs['cdecache'])
+    assert cdecache.readCDECache(conn, '2192199', ttl=1) is not None
+    conn.close()
+
+
+def test_cache_only_skips_misses(configs, cadsr):
+    resolve(configs, ['2192199'])
+    lookup = resolve(configs, ['2192199', '2006861'], cacheonly=True)
+    assert list(lookup) == ['2192199']
+    assert cadsr.requests == ['2192199']
+    assert cachedIDs(configs) == ['2192199']
+
+
+def test_refresh_ignores_the_cache(configs, cadsr):
+    resolve(configs, ['2192199'])
+    resolve(configs, ['2192199'], refresh=True)
+    assert cadsr.requests == ['2192199', '2192199']
+
+
+def test_failed_lookups_are_not_cached(configs, cadsr):
+    lookup = resolve(configs, ['9999999', '2192199'])
+    assert lookup['9999999']['cdename'] == 'caDSR Name Error'
+    assert cachedIDs(configs) == ['2192199']
+
+    # Retried on the next run
+    resolve(configs, ['9999999', '2192199'])
+    assert sorted(cadsr.requests) == ['2192199', '9999999', '9999999']
@@ -0,0 +1,114 @@
+# Incremental runs with --stream reading a CSV export: editing the CSV rebuilds the model (only the edited node for IDC2MDF.py), an untouched CSV doesn't
+# Usage: python -m pytest tests
+import argparse
+import csv
+import os
+import sys
+import warnings
+
+import pandas as pd
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CIDC2MDF
+import IDC2MDF
+import validation
+
+IDC_EDGESHEET = 'Relationships between nodes'
+
+
+def runArgs(**kwargs):
+    options = dict(configfile=None, verbose=1, incremental=True, stream=True, refresh_cdes=False, cache_only=False, revalidate=False, plan=False, from_cache=False, changelog=None, patch=None, stats=None, profile=None)
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def writeCIDCCSV(filename, props):
+    # Same layout as the worksheet: title rows, the header on row 9, the properties in columns G:K
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for r in range(8):
+            writer.writerow([f"Title line {r}"] + [''] * 10)
+        writer.writerow(list('abcdef') + ['Node', 'Property', 'Data Type', 'Permissible Value', 'Notes.1'])
+        for nodename, propname, pvs in props:
+            writer.writerow([''] * 6 + [nodename, propname, 'string', pvs, ''])
+
+
+@pytest.fixture
+def cidcconfigs(tmp_path):
+    return {'workingpath': str(tmp_path)+'/', 'excelfile': 'cidc.xlsx', 'csvfile': 'cidc.csv', 'worksheet': 'Gap Analysis',
+            'mdffile': 'cidc_model.yml', 'separate_files': False}
+
+
+def cidcProps(configs):
+    with open(configs['workingpath']+configs['mdffile']) as f:
+        return set(yaml.safe_load(f)['PropDefinitions'])
+
+
+def test_cidc_csv_edit_rebuilds(cidcconfigs, capsys):
+    warnings.simplefilter('ignore')
+    csvfile = cidcconfigs['workingpath']+cidcconfigs['csvfile']
+    props = [('Participant', 'participant_id', '-'), ('Sample', 'sample_type', "['Tumor', 'Normal']")]
+    writeCIDCCSV(csvfile, props)
+    CIDC2MDF.main(runArgs(), dict(cidcconfigs))
+    assert cidcProps(cidcconfigs) == {'participant_id', 'sample_type'}
+
+    # Nothing changed, nothing rebuilt
+    capsys.readouterr()
+    CIDC2MDF.main(runArgs(), dict(cidcconfigs))
+    assert "up to date" in capsys.readouterr().out
+
+    writeCIDCCSV(csvfile, props + [('Sample', 'sample_site', '-')])
+    CIDC2MDF.main(runArgs(), dict(cidcconfigs))
+    assert cidcProps(cidcconfigs) == {'participant_id', 'sample_type', 'sample_site'}
+
+
+def writeIDCCSV(filename, props):
+    # csvfile layout: every node's properties in one sheet with a Node column
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Node', 'Property', 'Description', 'Required/optional', 'Key', 'CDE', 'Permissible values'])
+        for nodename, propname in props:
+            writer.writerow([nodename, propname, f"The {propname}", 'O', '', '', ''])
+
+
+@pytest.fixture
+def idcconfigs(tmp_path):
+    # Only the relationships come from the workbook when csvfile is set.  No schema: validation falls back to the reference checks
+    configs = {'workingpath': str(tmp_path)+'/', 'excelfile': 'idc.xlsx', 'csvfile': 'idc.csv', 'excludetabs': [], 'edgesheet': IDC_EDGESHEET,
+               'handle': 'TEST', 'version': '1.0', 'loadsheetpath': None, 'mdfschema': str(tmp_path / 'no-schema.yaml'),
+               'mdffiles': [{'Model': 'idc_model.yml'}, {'PropDefinitions': 'idc_properties.yml'}]}
+    validation.VALIDATORS[configs['mdfschema']] = None
+    with pd.ExcelWriter(configs['workingpath']+configs['excelfile']) as writer:
+        pd.DataFrame([{'Source node': 'Sample', 'Destination node': 'Subject', 'Cardinality': 'many_to_one'}]).to_excel(writer, sheet_name=IDC_EDGESHEET, index=False)
+    return configs
+
+
+def idcProps(configs):
+    with open(configs['workingpath']+'idc_properties.yml') as f:
+        return set(yaml.safe_load(f)['PropDefinitions'])
+
+
+def test_idc_csv_edit_rebuilds_node(idcconfigs, capsys):
+    warnings.simplefilter('ignore')
+    csvfile = idcconfigs['workingpath']+idcconfigs['csvfile']
+    props = [('Subject', 'subject_id'), ('Sample', 'sample_type')]
+    writeIDCCSV(csvfile, props)
+    IDC2MDF.main(runArgs(), dict(idcconfigs))
+    assert idcProps(idcconfigs) == {'subject_id', 'sample_type'}
+
+    capsys.readouterr()
+    IDC2MDF.main(runArgs(), dict(idcconfigs))
+    assert "up to date" in capsys.readouterr().out
+
+    # Only the edited node is rebuilt, and the result is what a full --stream build gives
+    writeIDCCSV(csvfile, props + [('Sample', 'sample_site')])
+    IDC2MDF.main(runArgs(), dict(idcconfigs))
+    assert "Rebuilding sheets: ['sample']" in capsys.readouterr().out
+    assert idcProps(idcconfigs) == {'subject_id', 'sample_type', 'sample_site'}
+    with open(idcconfigs['workingpath']+'idc_model.yml') as f:
+        incrementalmodel = f.read()
+    IDC2MDF.main(runArgs(incremental=False), dict(idcconfigs))
+    with open(idcconfigs['workingpath']+'idc_model.yml') as f:
+        assert f.read() == incrementalmodel
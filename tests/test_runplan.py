@@ -0,0 +1,56 @@
+# --plan against a real run: the shard files the plan lists are the ones the run writes, with a property shared between nodes
+# Usage: python -m pytest tests
+import argparse
+import csv
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CIDC2MDF
+import runplan
+
+
+def runArgs(**kwargs):
+    options = dict(configfile=None, verbose=0, incremental=False, stream=True, plan=False, from_cache=False, changelog=None, patch=None, stats=None, profile=None)
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def writeCIDCCSV(filename, props):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for r in range(8):
+            writer.writerow([f"Title line {r}"] + [''] * 10)
+        writer.writerow(list('abcdef') + ['Node', 'Property', 'Data Type', 'Permissible Value', 'Notes.1'])
+        for nodename, propname in props:
+            writer.writerow([''] * 6 + [nodename, propname, 'string', '-', ''])
+
+
+def plannedFiles(output):
+    lines = output.splitlines()
+    start = [n for n, line in enumerate(lines) if line.startswith('Files that would be written')][0]
+    return sorted(line.strip().replace(' (new)', '') for line in lines[start+1:])
+
+
+def test_shared_property_counts_once(tmp_path, capsys):
+    # Participant and Sample share one PropDefinitions entry, so all three nodes fit in one shard of 3 properties
+    warnings.simplefilter('ignore')
+    configs = {'workingpath': str(tmp_path)+'/', 'excelfile': 'cidc.xlsx', 'csvfile': 'cidc.csv', 'worksheet': 'Gap Analysis',
+               'mdffile': 'cidc_model.yml', 'sharding': 3, 'shardpath': str(tmp_path)+'/shards/'}
+    writeCIDCCSV(configs['workingpath']+configs['csvfile'],
+                 [('Participant', 'participant_id'), ('Participant', 'comments'), ('Sample', 'comments'), ('Visit', 'visit_day')])
+
+    capsys.readouterr()
+    CIDC2MDF.main(runArgs(plan=True), dict(configs))
+    planned = plannedFiles(capsys.readouterr().out)
+    CIDC2MDF.main(runArgs(), dict(configs))
+    written = sorted(configs['shardpath']+filename for filename in os.listdir(configs['shardpath']))
+    assert planned == written
+    assert len(written) == 3
+
+
+def test_shard_file_list():
+    nodeprops = {'a': ['x', 'y'], 'b': ['y'], 'c': ['z'], 'd': ['w']}
+    assert runplan.shardFileList('s/', 'T', nodeprops, 3) == ['s/T_shards.yml', 's/T_model.yml', 's/T_shard_0001.yml', 's/T_shard_0002.yml']
+    assert len(runplan.shardFileList('s/', 'T', nodeprops, 'node')) == 6
@@ -0,0 +1,44 @@
+# The table cache round trip: a ModelBuilder saved with writeTables and loaded back with readTables/loadBuilder holds the same tables
+# Usage: python -m pytest tests
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import modelbuilder
+import tablecache
+
+pytest.importorskip('pyarrow')
+
+
+def sampleBuilder():
+    builder = modelbuilder.ModelBuilder('TEST', '1.0')
+    builder.addNodes(['subject', 'sample'])
+    builder.addProp('subject', 'subject_id', 'Yes', 'string', 'The subject', 'True')
+    builder.addProp('subject', 'sex', 'No', 'value_set', None)
+    builder.addProp('sample', 'sample_type', 'No', 'string', 'What the sample is')
+    builder.annotate('subject', 'subject_id', {'handle': 'subject_id', 'value': 'Subject Identifier', 'origin_name': 'caDSR', 'origin_id': '2192199',
+                                               'origin_version': '1.00', 'origin_definition': None, 'nanoid': 'cdeurl'})
+    builder.addEnums('subject', 'sex', ['Male', 'Female', 'Unknown'])
+    builder.addEdge('of_subject', 'many_to_one', 'sample', 'subject', None)
+    builder.addTag('node', 'subject', {'key': 'category', 'value': 'administrative'})
+    builder.addTag('node', 'sample', {'key': 'Template', 'value': False})
+    return builder
+
+
+@pytest.mark.parametrize('fileformat', tablecache.TABLE_FORMATS)
+def test_round_trip(tmp_path, fileformat):
+    tables = tablecache.builderTables(sampleBuilder())
+    tablecache.writeTables(tables, str(tmp_path), fileformat, handle='TEST')
+    cached, meta = tablecache.readTables(str(tmp_path))
+    assert meta['handle'] == 'TEST'
+    assert meta['tables']['enums'] == 3
+    loaded = tablecache.loadBuilder(modelbuilder.ModelBuilder('TEST', '1.0'), cached)
+    assert tablecache.builderTables(loaded) == tables
+
+
+def test_rows_are_batched_dictionaries(tmp_path):
+    tablecache.writeTables({'props': {'node': ['a', 'b'], 'prop': ['x', None]}}, str(tmp_path))
+    cached, meta = tablecache.readTables(str(tmp_path))
+    assert list(tablecache.rows(cached['props'])) == [{'node': 'a', 'prop': 'x'}, {'node': 'b', 'prop': None}]
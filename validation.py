@@ -0,0 +1,90 @@
+# MDF validation run against the MDF dictionary already in memory, so the files just written don't have to be parsed again.
+# The MDF JSON schema is loaded and compiled once per process and kept on disk so offline runs can still validate.
+import os
+
+from lazy import lazyImport
+
+requests = lazyImport('requests')
+mdfvalidator = lazyImport('bento_mdf.validator')
+jsonschema = lazyImport('jsonschema')
+
+# Compiled validators, keyed by schema file
+VALIDATORS = {}
+
+
+def fetchSchema(schemafile):
+    # Downloads the published MDF schema to schemafile.  Returns False if it couldn't be fetched
+    try:
+        results = requests.get(mdfvalidator.MDFSCHEMA_URL, timeout=10)
+        results.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Could not fetch the MDF schema:\n{e}")
+        return False
+    with open(schemafile, 'w') as f:
+        f.write(results.text)
+    return True
+
+
+def schemaValidator(schemafile):
+    # Returns a compiled Draft6Validator for the schema in schemafile, fetching the schema first if the file isn't there.  None if no schema is available.
+    if schemafile in VALIDATORS:
+        return VALIDATORS[schemafile]
+    validator = None
+    if os.path.exists(schemafile) or fetchSchema(schemafile):
+        schema = mdfvalidator.MDFValidator(schemafile).load_and_validate_schema()
+        if schema:
+            validator = jsonschema.Draft6Validator(schema)
+    VALIDATORS[schemafile] = validator
+    return validator
+
+
+def checkReferences(mdfdict):
+    # Cross reference checks the schema can't do: node props, relationship ends and enum terms must all be defined
+    errors = []
+    nodes = mdfdict.get('Nodes') or {}
+    propdefs = mdfdict.get('PropDefinitions') or {}
+    terms = mdfdict.get('Terms') or {}
+    for nodename, nodespec in nodes.items():
+        for propname in nodespec.get('Props') or []:
+            if propname not in propdefs:
+                errors.append({'path': f"Nodes/{nodename}/Props", 'message': f"Property '{propname}' has no PropDefinitions entry", 'check': 'reference'})
+    for edgename, edgespec in (mdfdict.get('Relationships') or {}).items():
+        for end in edgespec.get('Ends') or []:
+            for side in ['Src', 'Dst']:
+                if end.get(side) not in nodes:
+                    errors.append({'path': f"Relationships/{edgename}/Ends", 'message': f"{side} node '{end.get(side)}' is not in Nodes", 'check': 'reference'})
+    for propname, propspec in propdefs.items():
+        if isinstance(propspec.get('Enum'), list):
+            for value in propspec['Enum']:
+                if value not in terms:
+                    errors.append({'path': f"PropDefinitions/{propname}/Enum", 'message': f"Enum value '{value}' has no Terms entry", 'check': 'reference'})
+    return errors
+
+
+def validateMDF(mdfdict, schemafile, verbose=0):
+    # Validates an MDF dictionary against the MDF schema and checks its cross references.  Returns a list of every error found,
+    # each one a dictionary {'path': where in the MDF, 'message': what's wrong, 'check': 'schema' or 'reference'}
+    errors = []
+    validator = schemaValidator(schemafile)
+    if validator is None:
+        print(f"MDF schema not available at {schemafile}, only checking references")
+    else:
+        for error in validator.iter_errors(mdfdict):
+            errors.append({'path': '/'.join(str(part) for part in error.absolute_path), 'message': error.message, 'check': 'schema'})
+    errors.extend(checkReferences(mdfdict))
+    if verbose >= 1:
+        print(f"Validation found {len(errors)} errors")
+    return errors
+
+
+def printErrors(errors):
+    for error in errors:
+        print(f"{error['check']} error at {error['path']}: {error['message']}")
+
+
+def validateFiles(filelist, schemafile, verbose=0):
+    # The old post-write check: parses the written files again, merges them and validates the result
+    instance = mdfvalidator.MDFValidator(None, *filelist).load_and_validate_yaml()
+    if instance is None:
+        return [{'path': ', '.join(str(filename) for filename in filelist), 'message': 'Could not load the MDF files', 'check': 'yaml'}]
+    return validateMDF(instance.as_dict(), schemafile, verbose)
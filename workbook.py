@@ -0,0 +1,164 @@
+# Excel ingestion shared by the converters.  The workbook is opened and parsed once, sheets are then read from the open file as needed.
+import csv
+import importlib.util
+import hashlib
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+
+from lazy import lazyImport
+
+openpyxl = lazyImport('openpyxl')
+pd = lazyImport('pandas')
+
+XLSX_NS = {'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+           'rel': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+           'pkg': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+
+# Columns the IDC converter actually uses from each node tab
+IDC_COLUMNS = ['Property', 'Description', 'Required/optional', 'Key', 'CDE', 'Permissible values']
+
+
+def excelEngine(engine=None):
+    # Use calamine if it's installed, it's much faster than openpyxl.  An explicit engine always wins.
+    if engine is None and importlib.util.find_spec('python_calamine') is not None:
+        engine = 'calamine'
+    return engine
+
+
+def openWorkbook(filename, engine=None):
+    # Returns a pandas ExcelFile.  All sheets are read from this one object so the .xlsx is only parsed once.
+    return pd.ExcelFile(filename, engine=excelEngine(engine))
+
+
+def readSheet(xlfile, sheetname, columns=None, **kwargs):
+    # Reads a single sheet from an open workbook.  If columns is a list, only those columns are kept.  Other arguments go to ExcelFile.parse
+    if isinstance(columns, list):
+        kwargs['usecols'] = lambda colname: colname in columns
+    elif columns is not None:
+        kwargs['usecols'] = columns
+    return xlfile.parse(sheetname, **kwargs)
+
+
+def iterSheets(xlfile, exclude=None, columns=None, **kwargs):
+    # Generator of (sheetname, dataframe), reading each sheet only when it's asked for
+    if exclude is None:
+        exclude = []
+    for sheetname in xlfile.sheet_names:
+        if sheetname not in exclude:
+            yield sheetname, readSheet(xlfile, sheetname, columns, **kwargs)
+
+
+def columnSlice(columns):
+    # An Excel column range like "G:K" as a slice of a row tuple, None for all columns
+    if columns is None:
+        return slice(None)
+    first, last = columns.split(':')
+    return slice(openpyxl.utils.column_index_from_string(first) - 1, openpyxl.utils.column_index_from_string(last))
+
+
+def streamRows(rows, header=0, columns=None, rename=None):
+    # Generator of {column name: value} from raw row tuples, one row at a time.  header is the 0 based row holding the column names, as in pandas.
+    # columns is an Excel range ("G:K") or a list of names to keep.  rename is applied to the header names and the first column with a name wins.
+    # Empty cells are None and completely empty rows are skipped.
+    names = None
+    colslice = columnSlice(columns) if isinstance(columns, str) else slice(None)
+    for rownum, row in enumerate(rows):
+        if rownum < header:
+            continue
+        row = row[colslice]
+        if names is None:
+            names = {}
+            for index, name in enumerate(row):
+                if name is not None and name != '':
+                    name = str(name) if rename is None else rename(str(name))
+                    if isinstance(columns, list) and name not in columns:
+                        continue
+                    names.setdefault(name, index)
+            continue
+        values = {}
+        for name, index in names.items():
+            value = row[index] if index < len(row) else None
+            values[name] = None if value == '' else value
+        if any(value is not None for value in values.values()):
+            yield values
+
+
+def iterRows(filename, sheetname=None, header=0, columns=None, rename=None):
+    # Streams one worksheet, or a CSV export of one if filename ends in .csv, without loading it into a DataFrame.  See streamRows for the arguments
+    if filename.lower().endswith('.csv'):
+        with open(filename, newline='', encoding='utf-8-sig') as f:
+            yield from streamRows(csv.reader(f), header, columns, rename)
+    else:
+        book = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            yield from streamRows(book[sheetname].iter_rows(values_only=True), header, columns, rename)
+        finally:
+            book.close()
+
+
+def iterSheetRows(filename, exclude=None, columns=None):
+    # Generator of (sheetname, row generator) for every sheet not excluded.  The workbook is opened once in read-only mode, each sheet's rows
+    # must be used before moving on to the next sheet
+    if exclude is None:
+        exclude = []
+    book = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        for sheetname in book.sheetnames:
+            if sheetname not in exclude:
+                yield sheetname, streamRows(book[sheetname].iter_rows(values_only=True), 0, columns)
+    finally:
+        book.close()
+
+
+def cellText(element):
+    # All the text under an element, used for shared strings and inline strings
+    return ''.join(node.text or '' for node in element.iter(f"{{{XLSX_NS['main']}}}t"))
+
+
+def sheetNames(filename):
+    # The sheet names in workbook order, read from the .xlsx zip without loading any sheets
+    with zipfile.ZipFile(filename) as xlsx:
+        book = ET.fromstring(xlsx.read('xl/workbook.xml'))
+    return [sheet.get('name') for sheet in book.find('main:sheets', XLSX_NS)]
+
+
+def sheetFingerprints(filename):
+    # Returns {sheetname: content hash} straight from the .xlsx zip without building any dataframes, so it's cheap enough to run before deciding what to read.
+    # Only cell references and values are hashed, so formatting changes and resaving with a different tool don't count as changes.
+    fingerprints = {}
+    celltag = f"{{{XLSX_NS['main']}}}c"
+    valuetag = f"{{{XLSX_NS['main']}}}v"
+    inlinetag = f"{{{XLSX_NS['main']}}}is"
+    with zipfile.ZipFile(filename) as xlsx:
+        sheetfiles = {}
+        rels = ET.fromstring(xlsx.read('xl/_rels/workbook.xml.rels'))
+        for rel in rels.findall('pkg:Relationship', XLSX_NS):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                sheetfiles[rel.get('Id')] = target.lstrip('/')
+            else:
+                sheetfiles[rel.get('Id')] = posixpath.normpath(posixpath.join('xl', target))
+        sharedstrings = []
+        if 'xl/sharedStrings.xml' in xlsx.namelist():
+            sharedstrings = [cellText(si) for si in ET.fromstring(xlsx.read('xl/sharedStrings.xml'))]
+        book = ET.fromstring(xlsx.read('xl/workbook.xml'))
+        for sheet in book.find('main:sheets', XLSX_NS):
+            digest = hashlib.sha256()
+            with xlsx.open(sheetfiles[sheet.get(f"{{{XLSX_NS['rel']}}}id")]) as sheetxml:
+                for event, element in ET.iterparse(sheetxml):
+                    if element.tag == celltag:
+                        value = element.find(valuetag)
+                        if value is not None and element.get('t') == 's':
+                            text = sharedstrings[int(value.text)]
+                        elif value is not None:
+                            text = value.text or ''
+                        elif element.find(inlinetag) is not None:
+                            text = cellText(element.find(inlinetag))
+                        else:
+                            text = ''
+                        if text != '':
+                            digest.update(f"{element.get('r')}\0{text}\0".encode())
+                        element.clear()
+            fingerprints[sheet.get('name')] = digest.hexdigest()
+    return fingerprints